@@ -9,23 +9,86 @@ and feel of py.test.
 :copyright: see LICENSE for details
 :license: BSD, see LICENSE for more details.
 """
+import array
+import ast
 import collections
 import curses
+import gc
+import heapq
 import itertools
+import json
+import mmap
 import multiprocessing
 import os
+import queue
 import random
+import selectors
+import socket
+import stat
+import statistics
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
+import traceback
+import tracemalloc
 
 import pytest
+from _pytest.reports import CollectReport, TestReport
 from _pytest.terminal import TerminalReporter
 
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
 __version__ = '0.2.5'
 
 BLOB_SIZE = (10, 20)
 BLOB_SPEED = (0.1, 0.2)
+VERBOSE_POLICIES = ('coalesce', 'sample', 'drop-oldest')
+ORDERS = ('collection', 'longest-first')
+BASELINE_MODES = ('save', 'compare')
+BASELINE_RUNS = 5
+BASELINE_FACTOR = 2.0
+BASELINE_MARGIN = 0.1
+BASELINE_COLOR = 208
+FLAKY_WEIGHT = 0.2
+FLAKY_MIN_SCORE = 0.01
+REPEAT_WARMUP = 1
+SYSMON_INTERVAL = 0.5
+VERBOSE_QUEUE_SIZE = 100
+VERBOSE_SAMPLE_RATE = 10
+VERBOSE_BLOBS_PER_COLUMN = 2
 IS_NEO_ENABLED = False
+SLOW_FILE_DURATION = 5.0
+SLOW_FILE_MARK = '▓'
+STATUS_REFRESH_INTERVAL = 0.1
+PHASES = ('setup', 'call', 'teardown')
+SUMMARY_SIZE = 10
+HEAT_QUANTILES = (0.5, 0.9, 0.99)
+HEAT_COLORS = (2, 10, 11, 9)
+IDLE_COLOR = 12
+IDLE_MIN_WALL = 0.1
+IDLE_CPU_RATIO = 0.5
+RSS_COLOR = 13
+RSS_GROWTH_LIMIT = 10 * 1024 * 1024
+MEMORY_COLORS = (53, 90, 164, 201)
+MEMPROFILE_SAMPLE = 20
+MEMPROFILE_SITES = 3
+GC_COLOR = 14
+SAMPLE_INTERVAL = 5
+SAMPLE_MAX_STACKS = 10000
+SAMPLE_MAX_DEPTH = 64
+GLYPH_COLORIZERS = (
+    'neo-baseline', 'neo-gc', 'neo-rusage', 'neo-memprofile'
+)
+HANG_COLOR = 9
+FAILURE_COLOR = 9
+HANG_CHECK_INTERVAL = 0.5
+HANG_MIN_TIMEOUT = 1.0
 
 
 def pytest_addoption(parser):
@@ -37,6 +100,275 @@ def pytest_addoption(parser):
             "Force pytest-neo output even when not in real terminal"
         )
     )
+    group._addoption(
+        '--neo-verbose-policy', action="store", choices=VERBOSE_POLICIES,
+        dest="neo_verbose_policy", default=VERBOSE_POLICIES[0],
+        help=(
+            "What the verbose mode does with tests finishing faster than "
+            "they can be drawn: one blob per file, sample them or drop the "
+            "oldest (default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-verbose-queue', action="store", type=int, metavar="N",
+        dest="neo_verbose_queue", default=VERBOSE_QUEUE_SIZE,
+        help=(
+            "Number of tests waiting to be drawn in the verbose mode "
+            "(default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-order', action="store", choices=ORDERS,
+        dest="neo_order", default=ORDERS[0],
+        help=(
+            "Run the tests in collection order or start the files and tests "
+            "that took longest in the previous runs first "
+            "(default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-baseline', action="store", choices=BASELINE_MODES,
+        dest="neo_baseline", default=None,
+        help=(
+            "Save the test durations to the baseline in the pytest cache "
+            "or compare them against it"
+        )
+    )
+    group._addoption(
+        '--neo-baseline-runs', action="store", type=int, metavar="K",
+        dest="neo_baseline_runs", default=BASELINE_RUNS,
+        help=(
+            "Number of saved runs the baseline median is taken over "
+            "(default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-baseline-factor', action="store", type=float,
+        metavar="FACTOR", dest="neo_baseline_factor",
+        default=BASELINE_FACTOR,
+        help=(
+            "Flag tests FACTOR times slower than the baseline "
+            "(default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-baseline-margin', action="store", type=float,
+        metavar="SECONDS", dest="neo_baseline_margin",
+        default=BASELINE_MARGIN,
+        help=(
+            "Ignore tests less than SECONDS slower than the baseline "
+            "(default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-durations', action="store", type=int, metavar="N",
+        dest="neo_durations", default=0,
+        help=(
+            "Show the N slowest files and directories after the matrix"
+        )
+    )
+    group._addoption(
+        '--neo-fixture-profile', action="store_true",
+        dest="neo_fixture_profile", default=False,
+        help=(
+            "Profile fixture setup and teardown time per fixture"
+        )
+    )
+    group._addoption(
+        '--neo-import-profile', action="store_true",
+        dest="neo_import_profile", default=False,
+        help=(
+            "Show the test modules that are slowest to import and collect"
+        )
+    )
+    group._addoption(
+        '--neo-output-profile', action="store_true",
+        dest="neo_output_profile", default=False,
+        help=(
+            "Show the tests and files capturing the most output"
+        )
+    )
+    group._addoption(
+        '--neo-output-cap', action="store", type=int, metavar="BYTES",
+        dest="neo_output_cap", default=0,
+        help=(
+            "Truncate every captured section of passed tests to BYTES"
+        )
+    )
+    group._addoption(
+        '--neo-repeat', action="store", type=int, metavar="N",
+        dest="neo_repeat", default=0,
+        help=(
+            "Run the call of every test N times and show duration "
+            "statistics, fixtures are set up once"
+        )
+    )
+    group._addoption(
+        '--neo-repeat-warmup', action="store", type=int, metavar="N",
+        dest="neo_repeat_warmup", default=REPEAT_WARMUP,
+        help=(
+            "Unmeasured runs before the repeated ones (default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-sysmon', action="store_true",
+        dest="neo_sysmon", default=False,
+        help=(
+            "Show the CPU usage of the machine and the CPU and memory of "
+            "the test processes while tests run, linux only"
+        )
+    )
+    group._addoption(
+        '--neo-rusage', action="store_true",
+        dest="neo_rusage", default=False,
+        help=(
+            "Measure CPU time, context switches, block I/O and RSS growth "
+            "of every test and flag idle and memory hungry tests"
+        )
+    )
+    group._addoption(
+        '--neo-memprofile', action="store_true",
+        dest="neo_memprofile", default=False,
+        help=(
+            "Trace memory allocations of every test with tracemalloc"
+        )
+    )
+    group._addoption(
+        '--neo-memprofile-every', action="store", type=int, metavar="N",
+        dest="neo_memprofile_every", default=MEMPROFILE_SAMPLE,
+        help=(
+            "Take allocation site snapshots around every Nth test only "
+            "(default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-gc', action="store_true",
+        dest="neo_gc", default=False,
+        help=(
+            "Attribute garbage collector runs and pauses to tests"
+        )
+    )
+    group._addoption(
+        '--neo-sample', action="store_true",
+        dest="neo_sample", default=False,
+        help=(
+            "Sample the stack of the running test and show the hot spots"
+        )
+    )
+    group._addoption(
+        '--neo-sample-interval', action="store", type=float, metavar="MS",
+        dest="neo_sample_interval", default=SAMPLE_INTERVAL,
+        help=(
+            "Sampling interval in milliseconds (default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-sample-output', action="store", metavar="FILE",
+        dest="neo_sample_output", default=None,
+        help=(
+            "Write collapsed stacks for flame graph tools to FILE "
+            "(default: samples.folded in the pytest cache)"
+        )
+    )
+    group._addoption(
+        '--neo-trace', action="store", metavar="FILE",
+        dest="neo_trace", default=None,
+        help=(
+            "Stream a Chrome trace-event file of the run to FILE"
+        )
+    )
+    group._addoption(
+        '--neo-failures', action="store", metavar="FILE",
+        dest="neo_failures", default=None,
+        help=(
+            "Write the details of every failure to FILE as soon as it "
+            "happens and show the last one on screen"
+        )
+    )
+    group._addoption(
+        '--neo-record', action="store", metavar="FILE",
+        dest="neo_record", default=None,
+        help=(
+            "Record test events to a binary log in FILE"
+        )
+    )
+    group._addoption(
+        '--neo-replay', action="store", metavar="FILE",
+        dest="neo_replay", default=None,
+        help=(
+            "Draw the events recorded in FILE instead of running tests"
+        )
+    )
+    group._addoption(
+        '--neo-replay-speed', action="store", type=float, metavar="SPEED",
+        dest="neo_replay_speed", default=1.0,
+        help=(
+            "Replay speed factor, 0 replays as fast as possible "
+            "(default: %(default)s)"
+        )
+    )
+    group._addoption(
+        '--neo-serve', action="store", metavar="SOCKET",
+        dest="neo_serve", default=None,
+        help=(
+            "Draw the results streamed by --neo-connect processes to the "
+            "unix SOCKET instead of running tests"
+        )
+    )
+    group._addoption(
+        '--neo-shards', action="store", type=int, metavar="N",
+        dest="neo_shards", default=0,
+        help=(
+            "With --neo-serve, wait for N processes to finish, "
+            "by default until all connected processes have finished"
+        )
+    )
+    group._addoption(
+        '--neo-connect', action="store", metavar="SOCKET",
+        dest="neo_connect", default=None,
+        help=(
+            "Stream results to the --neo-serve process on the unix SOCKET, "
+            "which draws the progress"
+        )
+    )
+    group._addoption(
+        '--neo-watch', action="store_true",
+        dest="neo_watch", default=False,
+        help=(
+            "Keep the screen open and rerun the test files affected by "
+            "changed files"
+        )
+    )
+    group._addoption(
+        '--neo-hang-timeout', action="store", type=float, metavar="SECONDS",
+        dest="neo_hang_timeout", default=0,
+        help=(
+            "Highlight tests running for longer than SECONDS"
+        )
+    )
+    group._addoption(
+        '--neo-hang-factor', action="store", type=float, metavar="FACTOR",
+        dest="neo_hang_factor", default=0,
+        help=(
+            "Highlight tests running FACTOR times longer than in the "
+            "previous run, but not sooner than --neo-hang-timeout"
+        )
+    )
+    group._addoption(
+        '--neo-hang-dump', action="store", metavar="FILE",
+        dest="neo_hang_dump", default=None,
+        help=(
+            "Append the stack of highlighted tests to FILE, "
+            "not available with xdist"
+        )
+    )
+    group._addoption(
+        '--neo-heatmap', action="store_true",
+        dest="neo_heatmap", default=False,
+        help=(
+            "Color test results by their duration relative to the run"
+        )
+    )
 
 
 @pytest.mark.trylast
@@ -45,14 +377,127 @@ def pytest_configure(config):
 
     if sys.stdout.isatty() or config.getvalue('force_neo'):
         IS_NEO_ENABLED = True
+    if config.getvalue('neo_connect'):
+        # the server draws the results of this process
+        IS_NEO_ENABLED = False
 
-    if IS_NEO_ENABLED and not getattr(config, 'slaveinput', None):
+    if IS_NEO_ENABLED and not is_xdist_worker(config):
         # Get the standard terminal reporter plugin and replace it with our
         standard_reporter = config.pluginmanager.getplugin('terminalreporter')
         config.pluginmanager.unregister(standard_reporter)
         neo_reporter = NeoTerminalReporter(config, sys.stdout)
         config.pluginmanager.register(neo_reporter, 'terminalreporter')
 
+    if config.getvalue('neo_replay'):
+        config.pluginmanager.register(
+            Replayer(
+                config.getvalue('neo_replay'),
+                config.getvalue('neo_replay_speed'),
+            ),
+            'neo-replay'
+        )
+    elif config.getvalue('neo_watch'):
+        config.pluginmanager.register(Watcher(config), 'neo-watch')
+    elif config.getvalue('neo_serve'):
+        config.pluginmanager.register(
+            Server(
+                config.getvalue('neo_serve'),
+                config.getvalue('neo_shards'),
+            ),
+            'neo-serve'
+        )
+    elif get_cache_dir(config) and not is_xdist_worker(config):
+        config.pluginmanager.register(DurationCache(config), 'neo-durations')
+        config.pluginmanager.register(RerunCost(config), 'neo-reruns')
+
+    if config.getvalue('neo_baseline') and not is_xdist_worker(config):
+        if get_cache_dir(config) is None:
+            raise pytest.UsageError(
+                '--neo-baseline requires the cacheprovider plugin'
+            )
+        config.pluginmanager.register(Baseline(config), 'neo-baseline')
+
+    if config.getvalue('neo_connect') and not is_xdist_worker(config):
+        config.pluginmanager.register(Client(config), 'neo-connect')
+
+    if config.getvalue('neo_record') and not is_xdist_worker(config):
+        config.pluginmanager.register(
+            Recorder(config.getvalue('neo_record')), 'neo-record'
+        )
+
+    if config.getvalue('neo_failures') and not is_xdist_worker(config):
+        config.pluginmanager.register(
+            FailureWriter(config.getvalue('neo_failures')), 'neo-failures'
+        )
+
+    if config.getvalue('neo_trace') and not is_xdist_worker(config):
+        config.pluginmanager.register(
+            TraceWriter(config.getvalue('neo_trace')), 'neo-trace'
+        )
+
+    if (config.getvalue('neo_hang_timeout') or
+            config.getvalue('neo_hang_factor')) and \
+            not is_xdist_worker(config):
+        config.pluginmanager.register(HangMonitor(config), 'neo-hang')
+
+    if (config.getvalue('neo_output_profile') or
+            config.getvalue('neo_output_cap') > 0) and \
+            not is_xdist_worker(config):
+        config.pluginmanager.register(OutputMonitor(config), 'neo-output')
+
+    if config.getvalue('neo_repeat') > 0:
+        config.pluginmanager.register(Repeater(config), 'neo-repeat')
+
+    if config.getvalue('neo_sysmon') and not is_xdist_worker(config):
+        if not os.path.exists(SystemMonitor.STAT):
+            raise pytest.UsageError('--neo-sysmon requires /proc')
+        config.pluginmanager.register(SystemMonitor(config), 'neo-sysmon')
+
+    if config.getvalue('neo_rusage'):
+        if resource is None:
+            raise pytest.UsageError(
+                '--neo-rusage requires the resource module'
+            )
+        config.pluginmanager.register(ResourceMonitor(config), 'neo-rusage')
+
+    if config.getvalue('neo_memprofile'):
+        config.pluginmanager.register(
+            MemoryProfiler(config), 'neo-memprofile'
+        )
+
+    if config.getvalue('neo_gc'):
+        config.pluginmanager.register(GCMonitor(config), 'neo-gc')
+
+    if config.getvalue('neo_sample'):
+        config.pluginmanager.register(Sampler(config), 'neo-sample')
+
+    if config.getvalue('neo_import_profile'):
+        config.pluginmanager.register(
+            ImportProfiler(config), 'neo-import-profile'
+        )
+
+    if config.getvalue('neo_fixture_profile'):
+        config.pluginmanager.register(
+            FixtureProfiler(config), 'neo-fixture-profile'
+        )
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(config, items):
+    if config.getvalue('neo_order') != 'longest-first':
+        return
+    durations = config.pluginmanager.getplugin('neo-durations')
+    if durations is None:
+        # xdist workers have no cache plugin of their own, they all read
+        # the same file and order their items the same way
+        if get_cache_dir(config) is None:
+            return
+        durations = DurationCache(config)
+    if not durations.loaded:
+        durations.load()
+    if durations.has_history():
+        items[:] = durations.longest_first(items)
+
 
 def pytest_report_teststatus(report):
     if not IS_NEO_ENABLED:
@@ -92,51 +537,119 @@ class NeoTerminalReporter(TerminalReporter):
         self.history = collections.defaultdict(list)
         self._show_progress_info = False
         self.verbose_reporter = None
+        self.current_fsid = None
+        self.status_lines = collections.OrderedDict()
+        self.status_colors = {}
+        self.status_last_draw = 0
+        # the hang monitor draws from its own thread
+        self.lock = threading.RLock()
+        self.current_nodeid = None
+        self.durations = None
+        self.expected_total = 0
+        self.expected_done = 0
+        self.tests_total = 0
+        self.tests_done = 0
+        self.run_start = None
+        self.heatmap = None
+        self.colorizers = []
+        self.tracer = None
+        self.columns = {}
+        self.redraw_columns = {}
+        self.saved_left = None
+        if config.getvalue('neo_heatmap'):
+            self.heatmap = HeatScale()
+        self.file_durations = collections.defaultdict(lambda: [0.0, 0.0, 0.0])
 
-    def tearup(self):
+    def create_screen(self):
+        self.tracer = self.config.pluginmanager.getplugin('neo-trace')
         self.stdscr = create_stdscr()
+        self.stdscr.clear()
+        self.left = -2
+        self.top = 0
+        self.previous_char = None
+        self.currentfspath = None
+        self.columns = {}
+        self.redraw_columns = {}
+        self.saved_left = None
         self.COLOR_CHAIN = itertools.cycle([
             curses.color_pair(10) ^ curses.A_BOLD,
             curses.color_pair(2),
             curses.color_pair(10),
         ])
+
+    def tearup(self):
+        self.create_screen()
+        if self.durations and self.durations.has_history():
+            self.status_lines['eta'] = ''
+        if self.config.pluginmanager.getplugin('neo-hang'):
+            self.status_lines['hang'] = ''
+            self.status_colors['hang'] = HANG_COLOR
+        if self.config.pluginmanager.getplugin('neo-repeat'):
+            self.status_lines['repeat'] = ''
+        if self.config.pluginmanager.getplugin('neo-sysmon'):
+            self.status_lines['sysmon'] = ''
+        if self.config.pluginmanager.getplugin('neo-failures'):
+            self.status_lines['failures'] = ''
+            self.status_colors['failures'] = FAILURE_COLOR
+        self.run_start = time.time()
         if self.verbosity > 0:
-            self.verbose_reporter = VerboseReporter(*BLOB_SPEED)
+            self.verbose_reporter = VerboseReporter(
+                *BLOB_SPEED,
+                size=self.config.getvalue('neo_verbose_queue'),
+                policy=self.config.getvalue('neo_verbose_policy')
+            )
             self.verbose_reporter.start()
 
     def teardown(self):
+        shed = 0
         if self.verbose_reporter:
+            shed = self.verbose_reporter.shed
             self.verbose_reporter.exit.set()
             self.verbose_reporter.join()
             self.verbose_reporter = None
 
-        if self.stdscr:
-            self.stdscr.keypad(0)
-            curses.echo()
-            try:
-                curses.nocbreak()
-            except curses.error:  # hack for tests
-                pass
-            try:
-                curses.endwin()
-            except curses.error:  # hack for tests
-                pass
-            _, max_x = self.stdscr.getmaxyx()
-            self.stdscr = None
+        with self.lock:
+            max_x = self.close_screen()
+        if max_x is not None:
             self.print_history(max_x)
+            if shed:
+                self._tw.line('{} tests were not drawn ({})'.format(
+                    shed, self.config.getvalue('neo_verbose_policy')
+                ))
+            self.print_durations()
+            baseline = self.config.pluginmanager.getplugin('neo-baseline')
+            if baseline:
+                baseline.print_regressions(self)
+
+    def close_screen(self):
+        if not self.stdscr:
+            return None
+        self.stdscr.keypad(0)
+        curses.echo()
+        try:
+            curses.nocbreak()
+        except curses.error:  # hack for tests
+            pass
+        try:
+            curses.endwin()
+        except curses.error:  # hack for tests
+            pass
+        _, max_x = self.stdscr.getmaxyx()
+        self.stdscr = None
+        return max_x
 
     def print_history(self, max_x):
         part_count = int(max_x / 2)
         history = sorted(
-            (self.prepare_fspath(name), tests)
+            (self.prepare_fspath(name), self.column_label(name), tests)
             for name, tests in self.history.items()
         )
         while history:
             history_part = history[:part_count]
             history = history[part_count:]
             columns = []
-            for name, tests in history_part:
-                column = name + ''.join(test for test in tests)
+            for _, name, tests in history_part:
+                column = [(letter, None) for letter in name] + tests
                 columns.append(column)
             row_num = 0
             while True:
@@ -149,8 +662,11 @@ class NeoTerminalReporter(TerminalReporter):
                 for column in columns:
                     color = next(color_chain)
                     if len(column) > row_num:
-                        letter = column[row_num]
-                        self._tw.write(color.format(letter))
+                        letter, glyph_color = column[row_num]
+                        if glyph_color is not None:
+                            self._tw.write(ansi_color(glyph_color, letter))
+                        else:
+                            self._tw.write(color.format(letter))
                         was_entry = True
                     else:
                         self._tw.write(' ')
@@ -160,6 +676,35 @@ class NeoTerminalReporter(TerminalReporter):
                     break
                 row_num += 1
 
+    def print_durations(self):
+        count = self.config.getvalue('neo_durations')
+        if count <= 0 or not self.file_durations:
+            return
+        dirs = collections.defaultdict(lambda: [0.0, 0.0, 0.0])
+        for fsid, phases in self.file_durations.items():
+            totals = dirs[os.path.dirname(fsid) or '.']
+            for i, duration in enumerate(phases):
+                totals[i] += duration
+        total = sum(map(sum, self.file_durations.values())) or 1
+        for title, durations in [
+            ('slowest files', self.file_durations),
+            ('slowest directories', dirs),
+        ]:
+            self.write_sep('=', title)
+            self._tw.line('{:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+                'total', 'setup', 'call', 'teardown', 'share'
+            ))
+            for name, phases in sorted(
+                    durations.items(),
+                    key=lambda item: sum(item[1]),
+                    reverse=True)[:count]:
+                self._tw.line(
+                    '{:8.2f}s {:8.2f}s {:8.2f}s {:8.2f}s {:5.1f}%  {}'.format(
+                        sum(phases), phases[0], phases[1], phases[2],
+                        100.0 * sum(phases) / total, name
+                    )
+                )
+
     def summary_errors(self):
         self.teardown()
         return super(NeoTerminalReporter, self).summary_errors()
@@ -190,8 +735,23 @@ class NeoTerminalReporter(TerminalReporter):
             name = name.replace(*pairs)
         return name
 
-    def fix_coordinate(self):
+    def column_label(self, fsid):
+        label = self.prepare_fspath(fsid)
+        if self.durations and self.durations.is_slow(fsid):
+            label = SLOW_FILE_MARK + label
+        return label
+
+    def get_maxyx(self):
+        # the bottom lines of the screen are kept for the status area
         max_y, max_x = self.stdscr.getmaxyx()
+        return max_y - len(self.status_lines), max_x
+
+    def can_write(self, top, left):
+        max_y, _ = self.get_maxyx()
+        return top < max_y and can_write(self.stdscr, top, left)
+
+    def fix_coordinate(self):
+        max_y, max_x = self.get_maxyx()
         if (max_y - 1, max_x - 1) == (self.top, self.left):
             self.top = 0
             self.left += 1
@@ -212,15 +772,15 @@ class NeoTerminalReporter(TerminalReporter):
         self.previous_char = self.top, self.left, letter, color
 
     def clear_column(self, left):
-        max_y, max_x = self.stdscr.getmaxyx()
+        max_y, max_x = self.get_maxyx()
         for top in range(max_y):
-            if can_write(self.stdscr, top, left):
+            if self.can_write(top, left):
                 self.stdscr.addstr(top, left, ' ')
         self.stdscr.refresh()
 
     def write_new_column(self):
         self.column_color = next(self.COLOR_CHAIN)
-        fspath = self.prepare_fspath(self.currentfspath)
+        fspath = self.column_label(self.current_fsid)
 
         self.clear_column(self.left)
         self.clear_column(self.left + 1)
@@ -235,32 +795,192 @@ class NeoTerminalReporter(TerminalReporter):
         fspath = self.config.rootdir.join(nodeid.split("::")[0])
         if fspath != self.currentfspath:
             self.currentfspath = fspath
-            self.left += 2
-            _, max_x = self.stdscr.getmaxyx()
-            if self.left >= max_x:
-                self.left = 0
+            self.current_fsid = nodeid.split("::")[0]
+            left = self.redraw_columns.pop(self.current_fsid, None)
+            if left is not None:
+                # the file is rerun, draw it over its previous column
+                if self.saved_left is None:
+                    self.saved_left = self.left
+                self.left = left
+            else:
+                if self.saved_left is not None:
+                    self.left, self.saved_left = self.saved_left, None
+                self.left += 2
+                _, max_x = self.stdscr.getmaxyx()
+                if self.left >= max_x:
+                    self.left = 0
+                self.columns[self.current_fsid] = self.left
             self.write_new_column()
 
+    def forget_files(self, fsids):
+        """Drops the results of files that are going to be rerun."""
+        fsids = set(fsids)
+        for fsid in fsids:
+            self.history.pop(fsid, None)
+            if fsid in self.columns:
+                self.redraw_columns[fsid] = self.columns[fsid]
+        for cat, reports in self.stats.items():
+            self.stats[cat] = [
+                report for report in reports
+                if getattr(report, 'nodeid', '').split('::')[0] not in fsids
+            ]
+        self.currentfspath = None
+
+    def report_collect(self, final=False):
+        if self.stdscr:
+            return
+        super(NeoTerminalReporter, self).report_collect(final)
+
+    def pytest_collection(self):
+        super(NeoTerminalReporter, self).pytest_collection()
+        if self.verbosity <= 0 and not self.config.getoption('collectonly'):
+            self.create_screen()
+
+    def pytest_collectreport(self, report):
+        super(NeoTerminalReporter, self).pytest_collectreport(report)
+        if not self.stdscr or '::' in report.nodeid:
+            return
+        if self.config.rootdir.join(report.nodeid).isfile():
+            self.write_fspath_result(report.nodeid, '')
+            if report.failed:
+                self.addstr('E', curses.color_pair(9))
+                self.stdscr.refresh()
+
     @pytest.hookimpl(trylast=True)
     def pytest_collection_finish(self, session):
+        if self.stdscr:
+            # hand the terminal back for the collection summary,
+            # tearup resumes the same curses session
+            try:
+                curses.endwin()
+            except curses.error:  # hack for tests
+                pass
+            self.stdscr = None
         super(NeoTerminalReporter, self).pytest_collection_finish(session)
+        self.durations = self.config.pluginmanager.getplugin('neo-durations')
+        self.tests_total = len(session.items)
+        if self.durations:
+            self.expected_total = sum(
+                self.durations.estimate(item.nodeid)
+                for item in session.items
+            )
+        self.colorizers = list(filter(None, map(
+            self.config.pluginmanager.getplugin, GLYPH_COLORIZERS
+        )))
         self.tearup()
 
     def pytest_internalerror(self, excrepr):
         self.teardown()
         return super(NeoTerminalReporter, self).pytest_internalerror(excrepr)
 
+    def get_glyph_color(self, report):
+        color = None
+        if self.heatmap is not None and report.when == 'call':
+            self.heatmap.add(report.duration)
+            color = HEAT_COLORS[self.heatmap.level(report.duration)]
+        for colorizer in self.colorizers:
+            glyph_color = colorizer.glyph_color(report)
+            if glyph_color is not None:
+                return glyph_color
+        return color
+
+    def update_status(self, force=False):
+        current_time = time.time()
+        if self.verbosity > 0 or not self.status_lines:
+            return
+        if not force and (
+                current_time - self.status_last_draw < STATUS_REFRESH_INTERVAL):
+            return
+        self.status_last_draw = current_time
+        if 'eta' in self.status_lines:
+            self.status_lines['eta'] = self.format_eta(current_time)
+        self.draw_status()
+
+    def draw_status(self):
+        start = time.time()
+        max_y, max_x = self.stdscr.getmaxyx()
+        top = max_y - len(self.status_lines)
+        for name, line in self.status_lines.items():
+            if top >= 0:
+                line = line[:max_x - 1].ljust(max_x - 1)
+                color = curses.color_pair(self.status_colors.get(name, 2))
+                try:
+                    self.stdscr.addstr(top, 0, line, color)
+                except curses.error:  # terminal is too small
+                    pass
+            top += 1
+        self.stdscr.refresh()
+        if self.tracer:
+            self.tracer.span('status', 'render', start)
+
+    def format_eta(self, current_time):
+        line = '{}/{}'.format(self.tests_done, self.tests_total)
+        if self.expected_done > 0:
+            # scale the historical estimate by the speed of this run
+            speed = (current_time - self.run_start) / self.expected_done
+            eta = (self.expected_total - self.expected_done) * speed
+            line += '  ETA {}:{:02d}'.format(*divmod(int(max(eta, 0)), 60))
+        return line
+
+    def show_utilization(self, line):
+        with self.lock:
+            if self.stdscr and 'sysmon' in self.status_lines:
+                self.status_lines['sysmon'] = line
+                self.update_status(force=True)
+
+    def show_repeat(self, nodeid, done, total):
+        with self.lock:
+            if not self.stdscr:
+                return
+            self.status_lines['repeat'] = '{}/{}  {}'.format(
+                done, total, nodeid
+            )
+            self.update_status(force=done == total)
+
+    def show_hang(self, nodeid, elapsed, count):
+        """Called by the hang monitor, nodeid is None once nothing hangs."""
+        with self.lock:
+            if not self.stdscr or self.verbosity > 0:
+                return
+            if nodeid is None:
+                self.status_lines['hang'] = ''
+            else:
+                line = 'running {:.1f}s  {}'.format(elapsed, nodeid)
+                if count > 1:
+                    line += '  (+{} more)'.format(count - 1)
+                self.status_lines['hang'] = line
+                if nodeid == self.current_nodeid and self.can_write(
+                        self.top, self.left):
+                    letter = ' '
+                    if self.previous_char and \
+                            self.previous_char[:2] == (self.top, self.left):
+                        letter = self.previous_char[2]
+                    self.stdscr.addstr(
+                        self.top, self.left, letter,
+                        curses.color_pair(HANG_COLOR) ^ curses.A_REVERSE
+                    )
+            self.draw_status()
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        self.tests_done += 1
+        if self.durations:
+            self.expected_done += self.durations.estimate(nodeid)
+        with self.lock:
+            if self.stdscr:
+                self.update_status()
+
     def pytest_runtest_logstart(self, nodeid, location):
-        if self.verbosity <= 0:
-            fsid = nodeid.split("::")[0]
-            self.write_fspath_result(fsid, "")
-        else:
-            self.verbose_reporter.queue.put((
-                self.prepare_fspath(nodeid),
-                next(self.COLOR_CHAIN)
-            ))
+        self.current_nodeid = nodeid
+        with self.lock:
+            if self.verbosity <= 0:
+                fsid = nodeid.split("::")[0]
+                self.write_fspath_result(fsid, "")
+            else:
+                self.verbose_reporter.push(nodeid, next(self.COLOR_CHAIN))
 
     def pytest_runtest_logreport(self, report):
+        phases = self.file_durations[report.nodeid.split('::')[0]]
+        phases[PHASES.index(report.when)] += report.duration
         cat, letter, word = pytest_report_teststatus(report=report)
         if isinstance(word, tuple):
             word, markup = word
@@ -273,20 +993,42 @@ class NeoTerminalReporter(TerminalReporter):
             # probably passed setup/teardown
             return
 
+        glyph_color = self.get_glyph_color(report)
         if report.when != 'teardown':
             if report.when == 'call' or report.skipped:
-                self.history[report.nodeid.split('::')[0]].append(letter)
+                self.history[report.nodeid.split('::')[0]].append(
+                    (letter, glyph_color)
+                )
 
         if self.verbosity <= 0:
-            if report.when == 'setup':
-                if not can_write(self.stdscr, self.top, self.left):
-                    self.left += 1
-                    self.write_new_column()
-            if report.when == 'teardown':
-                self.top += 1
+            with self.lock:
+                self.draw_report(report, letter, glyph_color)
+                if report.failed and 'failures' in self.status_lines:
+                    self.show_failure(report)
+
+    def show_failure(self, report):
+        count = sum(len(self.stats.get(cat, [])) for cat in ('failed', 'error'))
+        self.status_lines['failures'] = '{} failed, last: {}'.format(
+            count, describe_failure(report)
+        )
+        self.update_status(force=True)
+
+    def draw_report(self, report, letter, glyph_color):
+        start = time.time()
+        if report.when == 'setup':
+            if not self.can_write(self.top, self.left):
+                self.left += 1
+                self.write_new_column()
+        if report.when == 'teardown':
+            self.top += 1
+        else:
+            if glyph_color is not None:
+                self.addstr(letter, curses.color_pair(glyph_color))
             else:
                 self.addstr(letter, self.column_color)
-                self.stdscr.refresh()
+            self.stdscr.refresh()
+        if self.tracer:
+            self.tracer.span('refresh', 'render', start)
 
 
 def can_write(stdscr, top, left):
@@ -345,22 +1087,71 @@ class Blob(object):
 class VerboseReporter(multiprocessing.Process):
     REFRESH_INTERVAL = 0.01
 
-    def __init__(self, speed_min, speed_max):
+    def __init__(self, speed_min, speed_max,
+                 size=VERBOSE_QUEUE_SIZE, policy=VERBOSE_POLICIES[0]):
         super(VerboseReporter, self).__init__()
         self.blobs = collections.defaultdict(list)
         assert self.REFRESH_INTERVAL <= speed_min < speed_max
+        assert policy in VERBOSE_POLICIES
         self.speed_min = speed_min
         self.speed_max = speed_max
         self._killed = False
-        self.queue = multiprocessing.Queue()
+        self.queue = multiprocessing.Queue(max(size, 1))
         self.exit = multiprocessing.Event()
+        # the fields below are only used by the process running the tests
+        self.policy = policy
+        self.shed = 0
+        self.count = 0
+        self.overloaded = False
+        self.pending = None
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def push(self, nodeid, color):
+        """Queues a test for drawing, shedding tests when the queue is full."""
+        item = (NeoTerminalReporter.prepare_fspath(nodeid), color)
+        if self.policy == 'drop-oldest':
+            while not self.put(item):
+                try:
+                    self.queue.get_nowait()
+                    self.shed += 1
+                except queue.Empty:
+                    pass
+        elif self.policy == 'sample':
+            self.count += 1
+            if self.overloaded and self.count % VERBOSE_SAMPLE_RATE:
+                self.shed += 1
+                return
+            self.overloaded = not self.put(item)
+            if self.overloaded:
+                self.shed += 1
+        else:
+            # coalesce into one blob for the file while the queue is full
+            fsid = nodeid.split('::')[0]
+            if self.pending is not None and self.put(self.pending[1]):
+                self.pending = None
+            if self.pending is None and self.put(item):
+                return
+            self.shed += 1
+            if self.pending is None or self.pending[0] != fsid:
+                self.pending = (
+                    fsid, (NeoTerminalReporter.prepare_fspath(fsid), color)
+                )
 
     def run(self):
         self.stdscr = create_stdscr()
         try:
             while not self.exit.is_set():
-                if not self.queue.empty():
-                    data = self.queue.get_nowait()
+                if self.can_add_blob():
+                    try:
+                        data = self.queue.get_nowait()
+                    except queue.Empty:
+                        data = None
                     if data:
                         self.add_nodeid(*data)
                 self.draw()
@@ -368,6 +1159,11 @@ class VerboseReporter(multiprocessing.Process):
         except KeyboardInterrupt:
             pass
 
+    def can_add_blob(self):
+        _, max_x = self.stdscr.getmaxyx()
+        count = sum(len(blobs) for blobs in self.blobs.values())
+        return count < max_x * VERBOSE_BLOBS_PER_COLUMN
+
     def get_random_column(self):
         max_y, max_x = self.stdscr.getmaxyx()
         cols = {n: max_y for n in range(max_x)}
@@ -418,6 +1214,2199 @@ class VerboseReporter(multiprocessing.Process):
         )
 
 
+class P2Quantile(object):
+    """Streaming estimation of a quantile with the P-square algorithm.
+
+    Jain & Chlamtac, 1985: five markers are adjusted on every observation,
+    so memory stays constant however many values are added.
+    """
+
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [
+            1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5
+        ]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = 0
+            while value >= heights[k + 1]:
+                k += 1
+
+        positions = self.positions
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (
+                    d <= -1 and positions[i - 1] - positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self.linear(i, d)
+                heights[i] = height
+                positions[i] += d
+
+    def parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def linear(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+    def value(self):
+        heights = self.heights
+        if not heights:
+            return None
+        if len(heights) < 5:
+            return heights[int(round((len(heights) - 1) * self.quantile))]
+        return heights[2]
+
+
+class HeatScale(object):
+    """Maps a value to its heat level among all values seen so far."""
+
+    def __init__(self, quantiles=HEAT_QUANTILES):
+        self.estimators = [P2Quantile(q) for q in quantiles]
+
+    def add(self, value):
+        for estimator in self.estimators:
+            estimator.add(value)
+
+    def level(self, value):
+        level = 0
+        for estimator in self.estimators:
+            estimate = estimator.value()
+            if estimate is not None and value > estimate:
+                level += 1
+        return level
+
+
+class DurationCache(object):
+    """Per-test durations of the previous runs, kept in the pytest cache.
+
+    Durations are stored grouped by file as integer microseconds, which
+    keeps the file small and quick to load with a lot of nodeids.
+    """
+    FILENAME = 'durations.json'
+
+    def __init__(self, config):
+        self.config = config
+        self.path = os.path.join(get_cache_dir(config), self.FILENAME)
+        self.files = {}
+        self.file_totals = {}
+        self.mean = 0
+        self.loaded = False
+        self.current = collections.defaultdict(float)
+        # fsid -> names of the tests found by the collectors of the file
+        self.collected = collections.defaultdict(set)
+        # fsid -> collectors of the file found by their parents and those
+        # collected, a file is whole when its module and all of them were,
+        # selecting a node id leaves the module and siblings uncollected
+        self.found = collections.defaultdict(set)
+        self.reported = collections.defaultdict(set)
+
+    def has_history(self):
+        return bool(self.files)
+
+    def load(self):
+        self.loaded = True
+        self.files = load_json(self.path, {})
+        self.file_totals = {
+            fsid: sum(tests.values()) / 1e6
+            for fsid, tests in self.files.items()
+        }
+        count = sum(len(tests) for tests in self.files.values())
+        if count:
+            self.mean = sum(self.file_totals.values()) / count
+
+    def get(self, nodeid):
+        fsid, _, name = nodeid.partition('::')
+        duration = self.files.get(fsid, {}).get(name)
+        if duration is not None:
+            return duration / 1e6
+
+    def estimate(self, nodeid):
+        duration = self.get(nodeid)
+        if duration is not None:
+            return duration
+        fsid = nodeid.partition('::')[0]
+        tests = self.files.get(fsid)
+        if tests:
+            return self.file_totals[fsid] / len(tests)
+        return self.mean
+
+    def longest_first(self, items):
+        """Orders the files, their classes and tests by duration.
+
+        The tests of a node stay together, so class and module scoped
+        fixtures are still set up once.
+        """
+        # key -> [total, children], the items are the leaves
+        tree = [0.0, collections.OrderedDict()]
+        for item in items:
+            duration = self.estimate(item.nodeid)
+            keys = [item.nodeid.partition('::')[0]] + [
+                node.nodeid for node in item.listchain()[:-1]
+                if '::' in node.nodeid
+            ]
+            node = tree
+            node[0] += duration
+            for key in keys:
+                node = node[1].setdefault(
+                    key, [0.0, collections.OrderedDict()]
+                )
+                node[0] += duration
+            node[1][item] = [duration, item]
+        ordered = []
+        pending = [tree]
+        while pending:
+            node = pending.pop()
+            if not isinstance(node[1], collections.OrderedDict):
+                ordered.append(node[1])
+                continue
+            # sorted is stable, ties keep the collection order
+            pending.extend(reversed(sorted(
+                node[1].values(), key=lambda child: child[0], reverse=True
+            )))
+        return ordered
+
+    def is_slow(self, fsid):
+        return self.file_totals.get(fsid, 0) >= SLOW_FILE_DURATION
+
+    def save(self):
+        # other processes may have saved their runs since the load
+        files = load_json(self.path, {})
+        # deleted and renamed tests of the files collected whole are dropped
+        for fsid, names in self.collected.items():
+            reported = self.reported[fsid]
+            if fsid not in reported or self.found[fsid] - reported:
+                continue
+            tests = {
+                name: duration
+                for name, duration in files.pop(fsid, {}).items()
+                if name in names
+            }
+            if tests:
+                files[fsid] = tests
+        for nodeid, duration in self.current.items():
+            fsid, _, name = nodeid.partition('::')
+            files.setdefault(fsid, {})[name] = int(duration * 1e6)
+        dump_json(self.path, files)
+
+    def pytest_collectreport(self, report):
+        fsid = report.nodeid.partition('::')[0]
+        if not report.passed:
+            # the tests of a broken collector are unknown
+            self.found[fsid].add(report.nodeid)
+            return
+        names = self.collected[fsid]
+        self.reported[fsid].add(report.nodeid)
+        for node in report.result:
+            if isinstance(node, pytest.Item):
+                names.add(node.nodeid.partition('::')[2])
+            else:
+                self.found[node.nodeid.partition('::')[0]].add(node.nodeid)
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collection_finish(self, session):
+        if not self.loaded:
+            self.load()
+
+    def pytest_runtest_logreport(self, report):
+        self.current[report.nodeid] += get_duration(report)
+
+    def pytest_sessionfinish(self, session):
+        if self.current:
+            self.save()
+
+
+class RerunCost(object):
+    """Time spent on rerun attempts and a flakiness score per test.
+
+    The score is an exponential moving average of the runs needing a
+    rerun, tests whose score decays to nothing are dropped from the cache.
+    """
+    FILENAME = 'flaky.json'
+
+    def __init__(self, config):
+        self.config = config
+        self.path = os.path.join(get_cache_dir(config), self.FILENAME)
+        # nodeid -> [duration, rerun] of the attempt being reported
+        self.attempts = {}
+        # nodeid -> [rerun time, reruns]
+        self.costs = collections.defaultdict(lambda: [0.0, 0])
+        # rerunfailures calls logfinish after every attempt
+        self.finished = set()
+        self.scores = {}
+
+    def flush(self, nodeid):
+        duration, rerun = self.attempts.pop(nodeid, (0.0, False))
+        if rerun:
+            cost = self.costs[nodeid]
+            cost[0] += duration
+            cost[1] += 1
+
+    def pytest_runtest_logreport(self, report):
+        if report.when == 'setup':
+            # the previous attempt ended, with its teardown if reported
+            self.flush(report.nodeid)
+        attempt = self.attempts.setdefault(report.nodeid, [0.0, False])
+        attempt[0] += report.duration
+        if report.outcome == 'rerun':
+            attempt[1] = True
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        self.flush(nodeid)
+        self.finished.add(nodeid)
+
+    def pytest_sessionfinish(self, session):
+        if not self.finished:
+            return
+        scores = load_json(self.path, {})
+        if not scores and not self.costs:
+            return
+        for nodeid in self.finished:
+            score = scores.get(nodeid, 0.0) * (1 - FLAKY_WEIGHT)
+            if nodeid in self.costs:
+                score += FLAKY_WEIGHT
+            if score >= FLAKY_MIN_SCORE:
+                scores[nodeid] = round(score, 4)
+            else:
+                scores.pop(nodeid, None)
+        dump_json(self.path, scores)
+        self.scores = scores
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.costs:
+            return
+        terminalreporter.write_sep('=', 'most expensive flaky tests')
+        terminalreporter.write_line('{:>9} {:>7} {:>6}'.format(
+            'reruns', 'count', 'score'
+        ))
+        for nodeid, (duration, count) in sorted(
+                self.costs.items(),
+                key=lambda item: item[1][0],
+                reverse=True)[:SUMMARY_SIZE]:
+            terminalreporter.write_line(
+                '{:8.2f}s {:7d} {:6.2f}  {}'.format(
+                    duration, count, self.scores.get(nodeid, 0.0), nodeid
+                )
+            )
+        terminalreporter.write_line('{} reruns took {:.2f}s'.format(
+            sum(count for _, count in self.costs.values()),
+            sum(duration for duration, _ in self.costs.values())
+        ))
+
+
+class Baseline(object):
+    """Per-test call durations of the last saved runs.
+
+    Every test keeps its last K durations as integer microseconds, the
+    baseline of a test is their median.
+    """
+    FILENAME = 'baseline.json'
+
+    def __init__(self, config):
+        self.config = config
+        self.path = os.path.join(get_cache_dir(config), self.FILENAME)
+        self.mode = config.getvalue('neo_baseline')
+        self.runs = max(config.getvalue('neo_baseline_runs'), 1)
+        self.factor = config.getvalue('neo_baseline_factor')
+        self.margin = config.getvalue('neo_baseline_margin')
+        self.files = load_json(self.path, {})
+        self.current = {}
+        # nodeid -> (duration, baseline)
+        self.regressions = {}
+        self.reported = False
+
+    def get(self, nodeid):
+        fsid, _, name = nodeid.partition('::')
+        durations = self.files.get(fsid, {}).get(name)
+        if durations:
+            durations = sorted(durations)
+            middle = len(durations) // 2
+            if len(durations) % 2:
+                return durations[middle] / 1e6
+            return (durations[middle - 1] + durations[middle]) / 2e6
+
+    def is_regression(self, report):
+        if self.mode != 'compare' or report.when != 'call' or \
+                not report.passed:
+            return False
+        baseline = self.get(report.nodeid)
+        if baseline is None:
+            return False
+        duration = get_duration(report)
+        return (
+            duration > baseline * self.factor and
+            duration - baseline > self.margin
+        )
+
+    def glyph_color(self, report):
+        if self.is_regression(report):
+            return BASELINE_COLOR
+        return None
+
+    def pytest_runtest_logreport(self, report):
+        if report.when != 'call' or not report.passed:
+            return
+        if self.mode == 'save':
+            self.current[report.nodeid] = get_duration(report)
+        elif self.is_regression(report):
+            self.regressions[report.nodeid] = (
+                get_duration(report), self.get(report.nodeid)
+            )
+
+    def pytest_sessionfinish(self, session):
+        if not self.current:
+            return
+        # other processes may have saved their runs since the load
+        files = load_json(self.path, {})
+        for nodeid, duration in self.current.items():
+            fsid, _, name = nodeid.partition('::')
+            durations = files.setdefault(fsid, {}).setdefault(name, [])
+            durations.append(int(duration * 1e6))
+            del durations[:-self.runs]
+        dump_json(self.path, files)
+
+    def print_regressions(self, terminalreporter):
+        self.reported = True
+        if not self.regressions:
+            return
+        terminalreporter.write_sep('=', 'slower than the baseline')
+        terminalreporter.write_line('{:>9} {:>9} {:>7}'.format(
+            'duration', 'baseline', 'ratio'
+        ))
+        for nodeid, (duration, baseline) in sorted(
+                self.regressions.items(),
+                key=lambda item: item[1][0] / max(item[1][1], 1e-6),
+                reverse=True):
+            terminalreporter.write_line(
+                '{:8.3f}s {:8.3f}s {:6.1f}x  {}'.format(
+                    duration, baseline, duration / max(baseline, 1e-6),
+                    nodeid
+                )
+            )
+
+    def pytest_terminal_summary(self, terminalreporter):
+        # the neo reporter lists them right after the matrix
+        if not self.reported:
+            self.print_regressions(terminalreporter)
+
+
+class FixtureProfiler(object):
+    """Collects setup and teardown time of every fixture instance."""
+
+    def __init__(self, config):
+        self.config = config
+        # (argname, scope) -> [count, setup time, teardown time]
+        self.stats = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        self.teardown_started = {}
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_fixture_setup(self, fixturedef, request):
+        start = time.perf_counter()
+        yield
+        stats = self.stats[fixturedef.argname, fixturedef.scope]
+        stats[0] += 1
+        stats[1] += time.perf_counter() - start
+        # finalizers run in reverse order, so this one runs first
+        fixturedef.addfinalizer(
+            lambda: self.teardown_started.__setitem__(
+                fixturedef, time.perf_counter()
+            )
+        )
+
+    def pytest_fixture_post_finalizer(self, fixturedef, request):
+        start = self.teardown_started.pop(fixturedef, None)
+        if start is not None:
+            stats = self.stats[fixturedef.argname, fixturedef.scope]
+            stats[2] += time.perf_counter() - start
+
+    def pytest_sessionfinish(self, session):
+        workeroutput = getattr(self.config, 'workeroutput', None)
+        if workeroutput is not None:
+            workeroutput['neo_fixture_profile'] = [
+                list(key) + stats for key, stats in self.stats.items()
+            ]
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_testnodedown(self, node, error):
+        workeroutput = getattr(node, 'workeroutput', {})
+        for argname, scope, count, setup, teardown in workeroutput.get(
+                'neo_fixture_profile', []):
+            stats = self.stats[argname, scope]
+            stats[0] += count
+            stats[1] += setup
+            stats[2] += teardown
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.stats:
+            return
+        terminalreporter.write_sep('=', 'fixture profile')
+        terminalreporter.write_line('{:>9} {:>9} {:>7}  {:<9} {}'.format(
+            'setup', 'teardown', 'count', 'scope', 'fixture'
+        ))
+        for (argname, scope), (count, setup, teardown) in sorted(
+                self.stats.items(),
+                key=lambda item: item[1][1] + item[1][2],
+                reverse=True)[:SUMMARY_SIZE]:
+            terminalreporter.write_line(
+                '{:8.3f}s {:8.3f}s {:>7}  {:<9} {}'.format(
+                    setup, teardown, count, scope, argname
+                )
+            )
+
+
+class ImportProfiler(object):
+    """Measures import and collection time of every test module."""
+
+    def __init__(self, config):
+        self.config = config
+        # nodeid -> (import time, collection time)
+        self.modules = {}
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_make_collect_report(self, collector):
+        if not isinstance(collector, pytest.Module):
+            yield
+            return
+        # the module is imported on the first access to its obj,
+        # wrap the getter of this collector to time that
+        imports = []
+        getobj = collector._getobj
+
+        def timed_getobj():
+            start = time.perf_counter()
+            try:
+                return getobj()
+            finally:
+                imports.append(time.perf_counter() - start)
+
+        collector._getobj = timed_getobj
+        start = time.perf_counter()
+        yield
+        total = time.perf_counter() - start
+        del collector._getobj
+        imported = sum(imports)
+        self.modules[collector.nodeid] = (imported, total - imported)
+
+    def pytest_sessionfinish(self, session):
+        workeroutput = getattr(self.config, 'workeroutput', None)
+        if workeroutput is not None:
+            workeroutput['neo_import_profile'] = self.modules
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_testnodedown(self, node, error):
+        workeroutput = getattr(node, 'workeroutput', {})
+        for nodeid, times in workeroutput.get(
+                'neo_import_profile', {}).items():
+            self.modules[nodeid] = max(
+                tuple(times), self.modules.get(nodeid, (0, 0))
+            )
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.modules:
+            return
+        terminalreporter.write_sep('=', 'slowest imports')
+        terminalreporter.write_line('{:>9} {:>9}  {}'.format(
+            'import', 'collect', 'module'
+        ))
+        for nodeid, (imported, collected) in sorted(
+                self.modules.items(),
+                key=lambda item: item[1],
+                reverse=True)[:SUMMARY_SIZE]:
+            terminalreporter.write_line('{:8.3f}s {:8.3f}s  {}'.format(
+                imported, collected, nodeid
+            ))
+
+
+class TopList(object):
+    """Keeps the entries with the largest keys in bounded memory."""
+
+    def __init__(self, size=SUMMARY_SIZE):
+        self.size = size
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, key, value):
+        entry = (key, next(self.counter), value)
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def items(self):
+        return [(key, value) for key, _, value in sorted(
+            self.heap, reverse=True
+        )]
+
+
+class OutputMonitor(object):
+    """Measures the captured output of every test and file.
+
+    Reports carry the sections of the previous phases too, only the
+    sections of their own phase are counted.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.profile = config.getvalue('neo_output_profile')
+        self.cap = config.getvalue('neo_output_cap')
+        self.current = collections.Counter()
+        self.files = collections.Counter()
+        self.tests = TopList()
+        self.truncated = 0
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_logreport(self, report):
+        suffix = ' ' + report.when
+        for title, content in report.sections:
+            if title.endswith(suffix):
+                size = len(content.encode('utf-8', 'replace'))
+                self.current[report.nodeid] += size
+                self.files[report.nodeid.split('::')[0]] += size
+        if self.cap > 0 and report.passed:
+            # runs before the reporter keeps the report in its stats,
+            # the sections of the previous phases were counted already
+            report.sections = [
+                (title, self.truncate(content, title.endswith(suffix)))
+                for title, content in report.sections
+            ]
+
+    def truncate(self, content, count):
+        data = content.encode('utf-8', 'replace')
+        if len(data) <= self.cap:
+            return content
+        if count:
+            self.truncated += len(data) - self.cap
+        return '{}\n[truncated {}]'.format(
+            data[:self.cap].decode('utf-8', 'ignore'),
+            format_size(len(data) - self.cap)
+        )
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        size = self.current.pop(nodeid, 0)
+        if size:
+            self.tests.add(size, nodeid)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.profile and self.files:
+            for title, items in [
+                ('heaviest output tests', self.tests.items()),
+                ('heaviest output files', [
+                    (size, fsid) for fsid, size
+                    in self.files.most_common(SUMMARY_SIZE)
+                ]),
+            ]:
+                terminalreporter.write_sep('=', title)
+                for size, name in items:
+                    terminalreporter.write_line('{:>9}  {}'.format(
+                        format_size(size), name
+                    ))
+        if self.truncated:
+            terminalreporter.write_line(
+                'truncated {} of output of passed tests'.format(
+                    format_size(self.truncated)
+                )
+            )
+
+
+class Repeater(object):
+    """Runs the function of every test several times and measures it.
+
+    The runs happen inside the call phase, so its output is captured.
+    Durations are kept in an array of doubles per test and attached to the
+    call report, so they reach the xdist controller.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.repeat = config.getvalue('neo_repeat')
+        self.warmup = max(config.getvalue('neo_repeat_warmup'), 0)
+        self.durations = None
+        self.running = False
+        self.last_progress = 0
+        self.tests = {}
+
+    def progress(self, nodeid, done):
+        total = self.warmup + self.repeat
+        now = time.time()
+        if done < total and now - self.last_progress < STATUS_REFRESH_INTERVAL:
+            return
+        self.last_progress = now
+        reporter = self.config.pluginmanager.getplugin('terminalreporter')
+        if not hasattr(reporter, 'show_repeat'):
+            return
+        # the runs happen inside the call capture, the screen is outside
+        capman = self.config.pluginmanager.getplugin('capturemanager')
+        if capman is not None:
+            with capman.global_and_fixture_disabled():
+                reporter.show_repeat(nodeid, done, total)
+        else:
+            reporter.show_repeat(nodeid, done, total)
+
+    def run(self, pyfuncitem):
+        self.running = True
+        try:
+            pyfuncitem.ihook.pytest_pyfunc_call(pyfuncitem=pyfuncitem)
+        finally:
+            self.running = False
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_pyfunc_call(self, pyfuncitem):
+        if self.running:
+            yield
+            return
+        nodeid = pyfuncitem.nodeid
+        for index in range(self.warmup):
+            self.run(pyfuncitem)
+            self.progress(nodeid, index + 1)
+        self.durations = array.array('d')
+        # the last run is the call of pytest, so it reports the failure
+        for index in range(self.repeat - 1):
+            start = time.perf_counter()
+            self.run(pyfuncitem)
+            self.durations.append(time.perf_counter() - start)
+            self.progress(nodeid, self.warmup + index + 1)
+        start = time.perf_counter()
+        yield
+        self.durations.append(time.perf_counter() - start)
+        self.progress(nodeid, self.warmup + self.repeat)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        if call.when == 'call' and self.durations is not None:
+            outcome.get_result().neo_repeat = self.durations.tolist()
+            self.durations = None
+
+    def pytest_runtest_logreport(self, report):
+        durations = getattr(report, 'neo_repeat', None)
+        if durations and report.passed:
+            self.tests[report.nodeid] = array.array('d', durations)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.tests or is_xdist_worker(self.config):
+            return
+        terminalreporter.write_sep('=', 'repeated tests')
+        terminalreporter.write_line('{:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+            'min', 'median', 'p95', 'stdev', 'runs'
+        ))
+        for nodeid, durations in sorted(
+                self.tests.items(),
+                key=lambda item: statistics.median(item[1]),
+                reverse=True):
+            ordered = sorted(durations)
+            p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+            stdev = statistics.stdev(ordered) if len(ordered) > 1 else 0.0
+            terminalreporter.write_line(
+                '{:8.6f}s {:8.6f}s {:8.6f}s {:8.6f}s {:6d}  {}'.format(
+                    ordered[0], statistics.median(ordered), p95, stdev,
+                    len(ordered), nodeid
+                )
+            )
+
+
+class SystemMonitor(object):
+    """Samples /proc for the CPU usage of the machine and the test processes.
+
+    A thread reads a few small files at a fixed rate, the samples are
+    summed per session phase. xdist workers are found by their pids.
+    """
+    STAT = '/proc/stat'
+    PHASES = ('collection', 'run')
+
+    def __init__(self, config):
+        self.config = config
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.cores = os.cpu_count() or 1
+        self.phase = self.PHASES[0]
+        # phase -> [wall, busy, iowait, total, process cpu, peak rss]
+        self.phases = collections.OrderedDict(
+            (phase, [0.0, 0, 0, 0, 0.0, 0]) for phase in self.PHASES
+        )
+        # gateway id -> pid of the xdist worker
+        self.workers = {}
+        self.last_time = None
+        self.last_stat = None
+        self.last_cpu = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.exit = threading.Event()
+
+    def read_stat(self):
+        with open(self.STAT) as f:
+            values = [int(value) for value in f.readline().split()[1:8]]
+        # user nice system idle iowait irq softirq
+        return sum(values), values[3] + values[4], values[4]
+
+    def read_process(self, pid):
+        with open('/proc/{}/stat'.format(pid)) as f:
+            data = f.read()
+        # the command name may contain spaces
+        fields = data[data.rindex(')') + 2:].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(self.ticks)
+        return cpu, int(fields[21]) * self.page_size
+
+    def sample(self):
+        with self.lock:
+            return self.take_sample()
+
+    def take_sample(self):
+        now = time.perf_counter()
+        total, idle, iowait = self.read_stat()
+        cpu = 0.0
+        rss = 0
+        last_cpu = {}
+        for pid in ['self'] + sorted(self.workers.values()):
+            try:
+                process_cpu, process_rss = self.read_process(pid)
+            except (OSError, ValueError, IndexError):  # worker is gone
+                continue
+            cpu += process_cpu - self.last_cpu.get(pid, process_cpu)
+            last_cpu[pid] = process_cpu
+            rss += process_rss
+        self.last_cpu = last_cpu
+        if self.last_stat is None:
+            self.last_time, self.last_stat = now, (total, idle, iowait)
+            return None
+        wall = now - self.last_time
+        total_delta = total - self.last_stat[0] or 1
+        busy_delta = total_delta - (idle - self.last_stat[1])
+        iowait_delta = iowait - self.last_stat[2]
+        self.last_time, self.last_stat = now, (total, idle, iowait)
+        phase = self.phases[self.phase]
+        phase[0] += wall
+        phase[1] += busy_delta
+        phase[2] += iowait_delta
+        phase[3] += total_delta
+        phase[4] += cpu
+        phase[5] = max(phase[5], rss)
+        return 'cpu {:3.0f}%  iowait {:2.0f}%  tests {:.1f}/{} cores  ' \
+            'rss {}'.format(
+                100.0 * busy_delta / total_delta,
+                100.0 * iowait_delta / total_delta,
+                cpu / wall if wall > 0 else 0.0, self.cores,
+                format_size(rss)
+            )
+
+    def run(self):
+        while not self.exit.wait(SYSMON_INTERVAL):
+            line = self.sample()
+            reporter = self.config.pluginmanager.getplugin(
+                'terminalreporter'
+            )
+            if line and hasattr(reporter, 'show_utilization'):
+                reporter.show_utilization(line)
+
+    def pytest_sessionstart(self, session):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name='neo-sysmon')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def pytest_collection_finish(self, session):
+        self.phase = self.PHASES[1]
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_xdist_node_collection_finished(self, node, ids):
+        # the xdist controller does not collect, its workers do
+        self.phase = self.PHASES[1]
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_testnodeready(self, node):
+        # workerinfo has no pid, execnet caches the remote one
+        try:
+            pid = node.gateway._rinfo().pid
+        except Exception:  # gateway went away or a different execnet
+            return
+        self.workers[node.gateway.id] = pid
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_testnodedown(self, node, error):
+        # account the last CPU time of the worker before it is gone
+        self.sample()
+        self.workers.pop(node.gateway.id, None)
+
+    def pytest_sessionfinish(self, session):
+        if self.thread is not None:
+            self.exit.set()
+            self.thread.join()
+            self.thread = None
+            self.sample()
+
+    def pytest_terminal_summary(self, terminalreporter):
+        phases = [
+            (name, phase) for name, phase in self.phases.items() if phase[0]
+        ]
+        if not phases:
+            return
+        terminalreporter.write_sep('=', 'system utilization')
+        terminalreporter.write_line(
+            '{:<10} {:>9} {:>6} {:>6} {:>9} {:>9}'.format(
+                'phase', 'wall', 'cpu', 'iowait', 'tests', 'peak rss'
+            )
+        )
+        for name, (wall, busy, iowait, total, cpu, rss) in phases:
+            total = total or 1
+            terminalreporter.write_line(
+                '{:<10} {:8.2f}s {:5.1f}% {:5.1f}% {:5.2f}/{:<3d} {:>9}'
+                .format(
+                    name, wall, 100.0 * busy / total, 100.0 * iowait / total,
+                    cpu / wall, self.cores, format_size(rss)
+                )
+            )
+
+
+class ResourceMonitor(object):
+    """Takes getrusage deltas around every test phase.
+
+    Deltas are attached to the reports, so they reach the xdist controller.
+    """
+    FIELDS = (
+        'wall', 'user', 'sys', 'vcsw', 'ivcsw', 'inblock', 'oublock', 'rss'
+    )
+    # ru_maxrss is in kilobytes, but in bytes on macOS
+    RSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+    def __init__(self, config):
+        self.config = config
+        self.phases = {}
+        self.tests = {}
+        self.idle = TopList()
+        self.rss = TopList()
+
+    @staticmethod
+    def snapshot():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return (
+            time.perf_counter(), usage.ru_utime, usage.ru_stime,
+            usage.ru_nvcsw, usage.ru_nivcsw,
+            usage.ru_inblock, usage.ru_oublock,
+            usage.ru_maxrss * ResourceMonitor.RSS_SCALE,
+        )
+
+    def measure(self, when):
+        before = self.snapshot()
+        yield
+        after = self.snapshot()
+        self.phases[when] = [b - a for a, b in zip(before, after)]
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_setup(self, item):
+        yield from self.measure('setup')
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_call(self, item):
+        yield from self.measure('call')
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_teardown(self, item):
+        yield from self.measure('teardown')
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        usage = self.phases.pop(call.when, None)
+        if usage is not None:
+            outcome.get_result().neo_rusage = usage
+
+    def glyph_color(self, report):
+        usage = getattr(report, 'neo_rusage', None)
+        if usage is None or report.when != 'call':
+            return None
+        if usage[7] >= RSS_GROWTH_LIMIT:
+            return RSS_COLOR
+        if self.is_idle(usage):
+            return IDLE_COLOR
+
+    @staticmethod
+    def is_idle(usage):
+        wall, cpu = usage[0], usage[1] + usage[2]
+        return wall >= IDLE_MIN_WALL and cpu < wall * IDLE_CPU_RATIO
+
+    def pytest_runtest_logreport(self, report):
+        usage = getattr(report, 'neo_rusage', None)
+        if usage is None:
+            return
+        total = self.tests.get(report.nodeid)
+        if total is None:
+            self.tests[report.nodeid] = list(usage)
+        else:
+            for i, value in enumerate(usage):
+                total[i] += value
+        if report.when == 'teardown':
+            total = self.tests.pop(report.nodeid)
+            if self.is_idle(total):
+                self.idle.add(total[0] - total[1] - total[2],
+                              (report.nodeid, total))
+            if total[7] > 0:
+                self.rss.add(total[7], (report.nodeid, total))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.idle:
+            terminalreporter.write_sep('=', 'idle tests (sleep or I/O)')
+            terminalreporter.write_line(
+                '{:>9} {:>9} {:>7} {:>7} {:>7} {:>7}  {}'.format(
+                    'wall', 'cpu', 'vcsw', 'ivcsw', 'inblk', 'outblk', 'test'
+                )
+            )
+            for _, (nodeid, usage) in self.idle.items():
+                terminalreporter.write_line(
+                    '{:8.3f}s {:8.3f}s {:>7} {:>7} {:>7} {:>7}  {}'.format(
+                        usage[0], usage[1] + usage[2], usage[3], usage[4],
+                        usage[5], usage[6], nodeid
+                    )
+                )
+        if self.rss:
+            terminalreporter.write_sep('=', 'max RSS growth')
+            for _, (nodeid, usage) in self.rss.items():
+                terminalreporter.write_line('{:>10}  {}'.format(
+                    format_size(usage[7]), nodeid
+                ))
+
+
+class MemoryProfiler(object):
+    """Peak and retained traced memory of every test.
+
+    Snapshots for allocation sites are costly, so they are only taken
+    around a sample of the tests.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.every = max(config.getvalue('neo_memprofile_every'), 1)
+        self.started = False
+        self.count = 0
+        self.before = 0
+        self.snapshot = None
+        self.heat = HeatScale()
+        self.files = collections.defaultdict(lambda: [0, 0])
+        self.leaks = TopList()
+
+    def pytest_sessionstart(self, session):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+
+    def pytest_unconfigure(self, config):
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_setup(self, item):
+        self.count += 1
+        self.snapshot = None
+        if self.count % self.every == 0:
+            self.snapshot = self.take_snapshot()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.before = tracemalloc.get_traced_memory()[0]
+        yield
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        if call.when == 'setup':
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        if not hasattr(tracemalloc, 'reset_peak'):
+            peak = current
+        sites = []
+        if call.when == 'teardown' and self.snapshot is not None:
+            stats = self.take_snapshot().compare_to(self.snapshot, 'lineno')
+            sites = [
+                [str(stat.traceback[0]), stat.size_diff]
+                for stat in stats[:MEMPROFILE_SITES] if stat.size_diff > 0
+            ]
+            self.snapshot = None
+        outcome.get_result().neo_memory = [
+            peak - self.before, current - self.before, sites
+        ]
+
+    def glyph_color(self, report):
+        memory = getattr(report, 'neo_memory', None)
+        if memory is None or report.when != 'call':
+            return None
+        return MEMORY_COLORS[self.heat.level(memory[0])]
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_logreport(self, report):
+        # fed before the reporter asks for the glyph color, which it
+        # does not for tests colored by another plugin
+        memory = getattr(report, 'neo_memory', None)
+        if memory is not None and report.when == 'call':
+            self.heat.add(memory[0])
+        if memory is None or report.when != 'teardown':
+            return
+        peak, retained, sites = memory
+        totals = self.files[report.nodeid.split('::')[0]]
+        totals[0] = max(totals[0], peak)
+        totals[1] += retained
+        if retained > 0:
+            self.leaks.add(retained, (report.nodeid, sites))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.files:
+            terminalreporter.write_sep('=', 'memory by file')
+            terminalreporter.write_line('{:>10} {:>10}  {}'.format(
+                'peak', 'retained', 'file'
+            ))
+            for fsid, (peak, retained) in sorted(
+                    self.files.items(),
+                    key=lambda item: item[1][1],
+                    reverse=True)[:SUMMARY_SIZE]:
+                terminalreporter.write_line('{:>10} {:>10}  {}'.format(
+                    format_size(peak), format_size(retained), fsid
+                ))
+        if self.leaks:
+            terminalreporter.write_sep('=', 'top retained memory')
+            for retained, (nodeid, sites) in self.leaks.items():
+                terminalreporter.write_line('{:>10}  {}'.format(
+                    format_size(retained), nodeid
+                ))
+                for site, size in sites:
+                    terminalreporter.write_line('{:>10}    {}'.format(
+                        format_size(size), site
+                    ))
+
+
+class GCMonitor(object):
+    """Garbage collections and their pauses during every test.
+
+    Reports carry the counts per generation and the pause time since the
+    start of the test.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.current = None
+        self.started = None
+        self.total = [0, 0, 0, 0.0]
+        self.offenders = TopList()
+
+    def pytest_sessionstart(self, session):
+        gc.callbacks.append(self.callback)
+
+    def pytest_unconfigure(self, config):
+        if self.callback in gc.callbacks:
+            gc.callbacks.remove(self.callback)
+
+    def callback(self, phase, info):
+        if self.current is None:
+            return
+        if phase == 'start':
+            self.started = time.perf_counter()
+        elif self.started is not None:
+            self.current[info['generation']] += 1
+            self.current[3] += time.perf_counter() - self.started
+            self.started = None
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        self.current = [0, 0, 0, 0.0]
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        self.current = None
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        if self.current is not None:
+            outcome.get_result().neo_gc = list(self.current)
+
+    def glyph_color(self, report):
+        stats = getattr(report, 'neo_gc', None)
+        if stats is not None and report.when == 'call' and stats[2]:
+            return GC_COLOR
+
+    def pytest_runtest_logreport(self, report):
+        stats = getattr(report, 'neo_gc', None)
+        if stats is None or report.when != 'teardown':
+            return
+        for i, value in enumerate(stats):
+            self.total[i] += value
+        if stats[3] > 0:
+            self.offenders.add(stats[3], (report.nodeid, stats))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.offenders:
+            return
+        terminalreporter.write_sep('=', 'garbage collection')
+        terminalreporter.write_line('{:>9} {:>7} {:>7} {:>7}  {}'.format(
+            'pause', 'gen0', 'gen1', 'gen2', 'test'
+        ))
+        for _, (nodeid, stats) in self.offenders.items():
+            terminalreporter.write_line(
+                '{:8.3f}s {:>7} {:>7} {:>7}  {}'.format(
+                    stats[3], stats[0], stats[1], stats[2], nodeid
+                )
+            )
+        terminalreporter.write_line(
+            '{:8.3f}s {:>7} {:>7} {:>7}  total'.format(
+                self.total[3], self.total[0], self.total[1], self.total[2]
+            )
+        )
+
+
+class Sampler(object):
+    """Statistical profiler attributing stack samples to the running test.
+
+    A thread reads the stack of the thread running the tests, so the memory
+    is bounded by the number of distinct stacks kept.
+    """
+    IGNORED = ('_pytest', 'pluggy', 'pytest', 'xdist', 'execnet')
+
+    def __init__(self, config):
+        self.config = config
+        self.interval = config.getvalue('neo_sample_interval') / 1000.0
+        self.output = config.getvalue('neo_sample_output')
+        self.rootdir = str(config.rootdir) + os.sep
+        self.ignored = tuple(
+            os.path.dirname(sys.modules[name].__file__) + os.sep
+            for name in self.IGNORED if name in sys.modules
+        ) + (__file__,)
+        self.current = None
+        self.ident = None
+        self.thread = None
+        self.exit = threading.Event()
+        self.labels = {}
+        self.stacks = collections.Counter()
+        self.files = collections.Counter()
+        self.functions = collections.Counter()
+        self.sampled_time = 0.0
+
+    def pytest_sessionstart(self, session):
+        if self.config.pluginmanager.hasplugin('dsession'):
+            # the xdist controller runs no tests, workeroutput brings
+            # the samples of the workers
+            return
+        self.ident = threading.get_ident()
+        self.thread = threading.Thread(target=self.run, name='neo-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        self.current = nodeid
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        self.current = None
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.exit.wait(self.interval):
+            nodeid = self.current
+            frame = sys._current_frames().get(self.ident)
+            now = time.perf_counter()
+            if nodeid is not None and frame is not None:
+                if self.sample(nodeid, frame):
+                    self.sampled_time += now - last
+            last = now
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            if filename.startswith(self.ignored):
+                label = ''
+            else:
+                if filename.startswith(self.rootdir):
+                    filename = filename[len(self.rootdir):]
+                else:
+                    filename = os.path.basename(filename)
+                label = '{}:{}'.format(filename, code.co_name)
+            self.labels[code] = label
+        return label
+
+    def sample(self, nodeid, frame):
+        labels = []
+        while frame is not None and len(labels) < SAMPLE_MAX_DEPTH:
+            label = self.label(frame.f_code)
+            if label:
+                labels.append(label)
+            elif labels:
+                # reached the pytest machinery running the test
+                break
+            frame = frame.f_back
+        if not labels:
+            return False
+        labels.append(nodeid)
+        stack = ';'.join(reversed(labels))
+        if stack in self.stacks or len(self.stacks) < SAMPLE_MAX_STACKS:
+            self.stacks[stack] += 1
+        else:
+            self.stacks[nodeid + ';[truncated]'] += 1
+        self.files[nodeid.split('::')[0]] += 1
+        self.functions[labels[0]] += 1
+        return True
+
+    def stop(self):
+        if self.thread is not None:
+            self.exit.set()
+            self.thread.join()
+            self.thread = None
+
+    def pytest_sessionfinish(self, session):
+        self.stop()
+        workeroutput = getattr(self.config, 'workeroutput', None)
+        if workeroutput is not None:
+            workeroutput['neo_sample'] = [
+                dict(self.stacks), dict(self.files), dict(self.functions),
+                self.sampled_time,
+            ]
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_testnodedown(self, node, error):
+        workeroutput = getattr(node, 'workeroutput', {})
+        if 'neo_sample' in workeroutput:
+            stacks, files, functions, sampled_time = workeroutput[
+                'neo_sample'
+            ]
+            self.sampled_time += sampled_time
+            self.stacks.update(stacks)
+            self.files.update(files)
+            self.functions.update(functions)
+
+    def write(self):
+        path = self.output
+        if path is None:
+            cache_dir = get_cache_dir(self.config)
+            if cache_dir is None:
+                return None
+            path = os.path.join(cache_dir, 'samples.folded')
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.items():
+                f.write('{} {}\n'.format(stack, count))
+        return path
+
+    def pytest_terminal_summary(self, terminalreporter):
+        total = sum(self.files.values())
+        if not total:
+            return
+        path = self.write()
+        # the sampler thread wakes up later than asked under load
+        interval = self.sampled_time / total
+        for title, counter in [
+            ('hot test files', self.files),
+            ('hot functions', self.functions),
+        ]:
+            terminalreporter.write_sep('=', title)
+            for name, count in counter.most_common(SUMMARY_SIZE):
+                terminalreporter.write_line('{:8.3f}s {:5.1f}%  {}'.format(
+                    count * interval, 100.0 * count / total, name
+                ))
+        if path:
+            terminalreporter.write_line('collapsed stacks: {}'.format(path))
+
+
+class HangMonitor(object):
+    """Watches the running tests and reports the ones running for too long.
+
+    The limit of a test is either fixed or a factor of its duration in the
+    previous run. A thread checks the running tests, so a stuck test is
+    highlighted while it is still running.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.timeout = config.getvalue('neo_hang_timeout')
+        self.factor = config.getvalue('neo_hang_factor')
+        self.dump = config.getvalue('neo_hang_dump')
+        self.lock = threading.Lock()
+        # nodeid -> (start, limit)
+        self.running = {}
+        # nodeid -> longest elapsed time seen over the limit
+        self.hung = {}
+        self.shown = False
+        self.ident = None
+        self.local = True
+        self.thread = None
+        self.exit = threading.Event()
+
+    def limit(self, nodeid):
+        limit = self.timeout or None
+        durations = self.config.pluginmanager.getplugin('neo-durations')
+        if self.factor and durations is not None:
+            duration = durations.get(nodeid)
+            if duration is not None:
+                limit = max(
+                    duration * self.factor, self.timeout or HANG_MIN_TIMEOUT
+                )
+        return limit
+
+    def pytest_sessionstart(self, session):
+        self.ident = threading.get_ident()
+        # with xdist the tests run in other processes
+        self.local = not self.config.pluginmanager.hasplugin('dsession')
+        self.thread = threading.Thread(target=self.run, name='neo-hang')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        limit = self.limit(nodeid)
+        with self.lock:
+            self.running[nodeid] = time.time(), limit
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        with self.lock:
+            start, _ = self.running.pop(nodeid, (None, None))
+            if nodeid in self.hung:
+                self.hung[nodeid] = time.time() - start
+
+    def run(self):
+        while not self.exit.wait(HANG_CHECK_INTERVAL):
+            self.check()
+
+    def check(self):
+        now = time.time()
+        with self.lock:
+            hanging = sorted(
+                (now - start, nodeid)
+                for nodeid, (start, limit) in self.running.items()
+                if limit is not None and now - start > limit
+            )
+            new = [nodeid for _, nodeid in hanging if nodeid not in self.hung]
+            self.hung.update((nodeid, elapsed) for elapsed, nodeid in hanging)
+        for nodeid in new:
+            self.write_stack(nodeid, self.hung[nodeid])
+        if hanging:
+            elapsed, nodeid = hanging[-1]
+            self.show(nodeid, elapsed, len(hanging))
+        elif self.shown:
+            self.show(None, 0, 0)
+
+    def show(self, nodeid, elapsed, count):
+        self.shown = nodeid is not None
+        reporter = self.config.pluginmanager.getplugin('terminalreporter')
+        if hasattr(reporter, 'show_hang'):
+            reporter.show_hang(nodeid, elapsed, count)
+
+    def write_stack(self, nodeid, elapsed):
+        if not self.dump or not self.local:
+            return
+        frame = sys._current_frames().get(self.ident)
+        if frame is None:
+            return
+        with open(self.dump, 'a') as f:
+            f.write('{} running for {:.1f}s\n'.format(nodeid, elapsed))
+            f.write(''.join(traceback.format_stack(frame)))
+            f.write('\n')
+
+    def stop(self):
+        if self.thread is not None:
+            self.exit.set()
+            self.thread.join()
+            self.thread = None
+
+    def pytest_sessionfinish(self, session):
+        self.stop()
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.hung:
+            return
+        terminalreporter.write_sep('=', 'hanging tests')
+        for nodeid, elapsed in sorted(
+                self.hung.items(), key=lambda item: item[1], reverse=True):
+            terminalreporter.write_line('{:8.2f}s  {}'.format(elapsed, nodeid))
+        if self.dump and self.local:
+            terminalreporter.write_line('stacks: {}'.format(self.dump))
+
+
+class TraceWriter(object):
+    """Streams the run as a Chrome trace-event file (about:tracing, Perfetto).
+
+    Events are appended through a buffered file as they happen and the
+    closing bracket, optional in this format, is written at the end.
+    """
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.first = True
+        self.pid = os.getpid()
+        self.tracks = {}
+
+    def write(self, event):
+        if self.file is None:
+            return
+        if not self.first:
+            self.file.write(',\n')
+        self.first = False
+        self.file.write(json.dumps(event, separators=(',', ':')))
+
+    def get_track(self, name):
+        tid = self.tracks.get(name)
+        if tid is None:
+            tid = self.tracks[name] = len(self.tracks)
+            self.write({
+                'ph': 'M', 'name': 'thread_name', 'pid': self.pid,
+                'tid': tid, 'args': {'name': name},
+            })
+        return tid
+
+    def span(self, name, category, start, duration=None, track='neo',
+             args=None):
+        if duration is None:
+            duration = time.time() - start
+        event = {
+            'ph': 'X', 'name': name, 'cat': category,
+            'ts': int(start * 1e6), 'dur': int(duration * 1e6),
+            'pid': self.pid, 'tid': self.get_track(track),
+        }
+        if args:
+            event['args'] = args
+        self.write(event)
+
+    def pytest_sessionstart(self, session):
+        self.file = open(self.path, 'w', buffering=self.BUFFER_SIZE)
+        self.file.write('[\n')
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_make_collect_report(self, collector):
+        start = time.time()
+        yield
+        if isinstance(collector, pytest.Module):
+            self.span(collector.nodeid, 'collect', start, track='collection')
+
+    def pytest_runtest_logreport(self, report):
+        gateway = getattr(getattr(report, 'node', None), 'gateway', None)
+        duration = report.duration
+        start = getattr(report, 'start', 0) or time.time() - duration
+        self.span(
+            report.nodeid, report.when, start, duration,
+            track=gateway.id if gateway else 'tests',
+            args={'outcome': report.outcome},
+        )
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_unconfigure(self, config):
+        if self.file is not None:
+            self.file.write('\n]\n')
+            self.file.close()
+            self.file = None
+
+
+class FailureWriter(object):
+    """Appends the details of every failure to a file while tests run."""
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.count = 0
+
+    def pytest_sessionstart(self, session):
+        self.file = open(self.path, 'w', buffering=self.BUFFER_SIZE)
+
+    def pytest_runtest_logreport(self, report):
+        if self.file is None or not report.failed:
+            return
+        self.count += 1
+        title = ' {} [{}] '.format(report.nodeid, report.when)
+        self.file.write('{}\n{}\n\n'.format(
+            title.center(80, '_'), report.longreprtext
+        ))
+        # one flush per failure, somebody may be tailing the file
+        self.file.flush()
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_unconfigure(self, config):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.count:
+            terminalreporter.write_line('failure details: {}'.format(
+                self.path
+            ))
+
+
+EVENT_LOG_MAGIC = b'NEO\x02'
+# number of started tests, written when the recording is closed
+EVENT_LOG_COUNT = struct.Struct('<Q')
+EVENT_LOG_HEADER_SIZE = len(EVENT_LOG_MAGIC) + EVENT_LOG_COUNT.size
+EVENT_LENGTH = struct.Struct('<I')
+# kind, phase, outcome, flags, timestamp, duration, then the nodeid
+EVENT = struct.Struct('<BBBBdd')
+EVENT_LOGSTART = 0
+EVENT_LOGREPORT = 1
+EVENT_COLLECTREPORT = 2
+EVENT_WASXFAIL = 1
+OUTCOMES = ('passed', 'failed', 'skipped', 'rerun')
+EVENT_BATCH_SIZE = 64 * 1024
+EVENT_BATCH_INTERVAL = 0.1
+WATCH_INTERVAL = 0.5
+
+
+def encode_event(kind, nodeid, when='setup', outcome='passed', flags=0,
+                 timestamp=None, duration=0.0):
+    nodeid = nodeid.encode('utf-8')
+    if timestamp is None:
+        timestamp = time.time()
+    return EVENT_LENGTH.pack(EVENT.size + len(nodeid)) + EVENT.pack(
+        kind, PHASES.index(when), OUTCOMES.index(outcome), flags,
+        timestamp, duration
+    ) + nodeid
+
+
+def encode_report(report):
+    return encode_event(
+        EVENT_LOGREPORT, report.nodeid, report.when,
+        report.outcome if report.outcome in OUTCOMES else 'failed',
+        EVENT_WASXFAIL if hasattr(report, 'wasxfail') else 0,
+        duration=report.duration,
+    )
+
+
+def encode_collect_error(report):
+    return encode_event(EVENT_COLLECTREPORT, report.nodeid, outcome='failed')
+
+
+def decode_events(data, offset=0):
+    """Yields (kind, nodeid, when, outcome, flags, timestamp, duration).
+
+    Returns the offset of the first incomplete event.
+    """
+    size = len(data)
+    while offset + EVENT_LENGTH.size <= size:
+        length, = EVENT_LENGTH.unpack_from(data, offset)
+        start = offset + EVENT_LENGTH.size
+        end = start + length
+        if end > size:
+            break
+        kind, when, outcome, flags, timestamp, duration = (
+            EVENT.unpack_from(data, start)
+        )
+        nodeid = bytes(data[start + EVENT.size:end]).decode('utf-8')
+        yield (
+            kind, nodeid, PHASES[when], OUTCOMES[outcome], flags,
+            timestamp, duration
+        )
+        offset = end
+    return offset
+
+
+def make_report(nodeid, when, outcome, flags, duration):
+    fsid, _, name = nodeid.partition('::')
+    report = TestReport(
+        nodeid, (fsid, None, name), {}, outcome, None, when,
+        duration=duration,
+    )
+    if flags & EVENT_WASXFAIL:
+        report.wasxfail = ''
+    return report
+
+
+class Recorder(object):
+    """Appends test events and collection errors to a length-prefixed log."""
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.count = 0
+
+    def pytest_sessionstart(self, session):
+        self.file = open(self.path, 'wb', buffering=self.BUFFER_SIZE)
+        self.file.write(EVENT_LOG_MAGIC + EVENT_LOG_COUNT.pack(0))
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        if self.file is not None:
+            self.count += 1
+            self.file.write(encode_event(EVENT_LOGSTART, nodeid))
+
+    def pytest_runtest_logreport(self, report):
+        if self.file is not None:
+            self.file.write(encode_report(report))
+
+    def pytest_collectreport(self, report):
+        if self.file is not None and report.failed:
+            self.file.write(encode_collect_error(report))
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_unconfigure(self, config):
+        if self.file is not None:
+            self.file.seek(len(EVENT_LOG_MAGIC))
+            self.file.write(EVENT_LOG_COUNT.pack(self.count))
+            self.file.close()
+            self.file = None
+
+
+class Replayer(object):
+    """Feeds a recorded event log to the reporters instead of running tests.
+
+    The log is read through a memory map and the number of tests comes
+    from its header, so long recordings start at once.
+    """
+
+    def __init__(self, path, speed):
+        self.path = path
+        self.speed = speed
+
+    def check_header(self, header):
+        if header[:len(EVENT_LOG_MAGIC)] != EVENT_LOG_MAGIC:
+            raise pytest.UsageError(
+                '{} is not a neo event log'.format(self.path)
+            )
+
+    def count(self):
+        with open(self.path, 'rb') as f:
+            header = f.read(EVENT_LOG_HEADER_SIZE)
+        if len(header) < EVENT_LOG_HEADER_SIZE:
+            return 0
+        self.check_header(header)
+        count, = EVENT_LOG_COUNT.unpack_from(header, len(EVENT_LOG_MAGIC))
+        if not count:
+            # the recording was not closed, count the tests it has
+            count = sum(
+                1 for event in self.events() if event[0] == EVENT_LOGSTART
+            )
+        return count
+
+    def events(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < EVENT_LOG_HEADER_SIZE:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.check_header(data[:EVENT_LOG_HEADER_SIZE])
+                for event in decode_events(data, EVENT_LOG_HEADER_SIZE):
+                    yield event
+            finally:
+                data.close()
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collection(self, session):
+        session.items = []
+        session.testscollected = self.count()
+        session.config.hook.pytest_collection_finish(session=session)
+        return True
+
+    def pytest_report_collectionfinish(self, config, items):
+        return 'replaying {}'.format(self.path)
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtestloop(self, session):
+        hook = session.config.hook
+        started = first = None
+        for kind, nodeid, when, outcome, flags, timestamp, duration in (
+                self.events()):
+            if self.speed > 0:
+                if first is None:
+                    started, first = time.time(), timestamp
+                delay = (timestamp - first) / self.speed
+                delay -= time.time() - started
+                if delay > 0:
+                    time.sleep(delay)
+            dispatch_event(hook, kind, nodeid, when, outcome, flags, duration)
+        return True
+
+
+class Server(object):
+    """Draws the events streamed by several pytest processes.
+
+    Every --neo-connect process sends batches of the event log format
+    over a unix socket, so a single process owns the screen.
+    """
+
+    def __init__(self, path, shards):
+        self.path = path
+        self.shards = shards
+        self.listener = None
+        self.clients = {}
+        self.finished = 0
+        self.check_path()
+
+    def check_path(self):
+        """Only a stale socket of a previous server may be replaced."""
+        try:
+            mode = os.stat(self.path).st_mode
+        except FileNotFoundError:
+            return False
+        if not stat.S_ISSOCK(mode):
+            raise pytest.UsageError(
+                '{} exists and is not a socket'.format(self.path)
+            )
+        return True
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collection(self, session):
+        session.items = []
+        if self.check_path():
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(socket.SOMAXCONN)
+        session.config.hook.pytest_collection_finish(session=session)
+        return True
+
+    def pytest_report_collectionfinish(self, config, items):
+        return 'serving on {}'.format(self.path)
+
+    def is_done(self):
+        if self.shards:
+            return self.finished >= self.shards
+        return self.finished and not self.clients
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtestloop(self, session):
+        selector = selectors.DefaultSelector()
+        selector.register(self.listener, selectors.EVENT_READ)
+        try:
+            while not self.is_done():
+                self.poll(session, selector, STATUS_REFRESH_INTERVAL)
+        finally:
+            selector.close()
+        return True
+
+    def poll(self, session, selector, timeout):
+        for key, _ in selector.select(timeout=timeout):
+            if key.fileobj is self.listener:
+                client, _ = self.listener.accept()
+                self.clients[client] = bytearray()
+                selector.register(client, selectors.EVENT_READ)
+            elif not self.receive(session, key.fileobj):
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                del self.clients[key.fileobj]
+                self.finished += 1
+
+    def receive(self, session, client):
+        try:
+            data = client.recv(EVENT_BATCH_SIZE)
+        except ConnectionError:
+            # the shard died, what it sent so far is kept
+            return False
+        if not data:
+            return False
+        buffer = self.clients[client]
+        buffer += data
+        start = len(EVENT_LOG_MAGIC)
+        if len(buffer) < start:
+            return True
+        if not buffer.startswith(EVENT_LOG_MAGIC):
+            return False
+        events = decode_events(buffer, start)
+        while True:
+            try:
+                kind, nodeid, when, outcome, flags, _, duration = next(
+                    events
+                )
+            except StopIteration as stop:
+                # keep the incomplete event for the next batch
+                del buffer[start:stop.value]
+                return True
+            if kind == EVENT_LOGSTART:
+                session.testscollected += 1
+            dispatch_event(
+                session.config.hook,
+                kind, nodeid, when, outcome, flags, duration
+            )
+
+    def pytest_unconfigure(self, config):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class Client(object):
+    """Streams the events of this process to a --neo-serve process.
+
+    The server draws the progress, so the letters of the standard reporter
+    are left out while connected. Losing the server does not stop the run.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config.getvalue('neo_connect')
+        self.socket = None
+        self.buffer = bytearray(EVENT_LOG_MAGIC)
+        self.last_flush = 0
+
+    def pytest_sessionstart(self, session):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(self.path)
+        except OSError as e:
+            raise pytest.UsageError(
+                'can not connect to {}: {}'.format(self.path, e)
+            )
+
+    def disconnect(self, error):
+        self.socket.close()
+        self.socket = None
+        reporter = self.config.pluginmanager.getplugin('terminalreporter')
+        if reporter is not None:
+            reporter.write_line(
+                'lost the connection to {}: {}'.format(self.path, error)
+            )
+
+    def send(self, event):
+        if self.socket is None:
+            return
+        self.buffer += event
+        now = time.time()
+        if len(self.buffer) >= EVENT_BATCH_SIZE or (
+                now - self.last_flush >= EVENT_BATCH_INTERVAL):
+            self.flush()
+            self.last_flush = now
+
+    def flush(self):
+        if self.socket is not None and self.buffer:
+            try:
+                self.socket.sendall(self.buffer)
+            except OSError as e:
+                self.disconnect(e)
+        self.buffer.clear()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_report_teststatus(self, report):
+        outcome = yield
+        status = outcome.get_result()
+        if status and self.socket is not None:
+            outcome.force_result((status[0], '', ''))
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        self.send(encode_event(EVENT_LOGSTART, nodeid))
+
+    def pytest_runtest_logreport(self, report):
+        self.send(encode_report(report))
+
+    def pytest_collectreport(self, report):
+        # a broken file would silently vanish from the server otherwise
+        if report.failed:
+            self.send(encode_collect_error(report))
+
+    def pytest_sessionfinish(self, session):
+        if self.socket is not None:
+            self.flush()
+            self.socket.close()
+            self.socket = None
+
+
+class ImportGraph(object):
+    """Project files imported by each file, found by parsing the imports.
+
+    Direct imports are cached with the file mtime, so only changed files
+    are parsed again.
+    """
+
+    def __init__(self, rootdir, cache_path=None):
+        self.rootdir = rootdir
+        self.cache_path = cache_path
+        self.imports = load_json(cache_path, {}) if cache_path else {}
+        self.roots = [''] + sorted({
+            os.path.relpath(path, rootdir)
+            for path in sys.path
+            if path and os.path.abspath(path).startswith(rootdir + os.sep)
+        })
+
+    def find_module(self, path):
+        for candidate in (path + '.py', os.path.join(path, '__init__.py')):
+            if os.path.isfile(os.path.join(self.rootdir, candidate)):
+                return os.path.normpath(candidate)
+
+    def find(self, bases, name):
+        parts = name.split('.') if name else []
+        for base in bases:
+            found = self.find_module(os.path.join(base, *parts))
+            if found:
+                return found
+
+    def parse(self, relpath):
+        try:
+            with open(os.path.join(self.rootdir, relpath), 'rb') as f:
+                tree = ast.parse(f.read(), relpath)
+        except (OSError, SyntaxError, ValueError):
+            return []
+        directory = os.path.dirname(relpath)
+        dependencies = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    dependencies.add(
+                        self.find([directory] + self.roots, alias.name)
+                    )
+            elif isinstance(node, ast.ImportFrom):
+                if node.level:
+                    base = directory
+                    for _ in range(node.level - 1):
+                        base = os.path.dirname(base)
+                    bases = [base]
+                else:
+                    bases = [directory] + self.roots
+                module = node.module or ''
+                dependencies.add(self.find(bases, module))
+                for alias in node.names:
+                    dependencies.add(self.find(
+                        bases, '.'.join(filter(None, [module, alias.name]))
+                    ))
+        dependencies.discard(None)
+        dependencies.discard(relpath)
+        return sorted(dependencies)
+
+    def direct(self, relpath):
+        try:
+            mtime = os.stat(os.path.join(self.rootdir, relpath)).st_mtime
+        except OSError:
+            return []
+        entry = self.imports.get(relpath)
+        if entry is None or entry[0] != mtime:
+            entry = self.imports[relpath] = [mtime, self.parse(relpath)]
+        return entry[1]
+
+    def conftests(self, relpath):
+        directory = os.path.dirname(relpath)
+        while True:
+            conftest = os.path.join(directory, 'conftest.py')
+            if os.path.isfile(os.path.join(self.rootdir, conftest)):
+                yield conftest
+            if not directory:
+                break
+            directory = os.path.dirname(directory)
+
+    def closure(self, relpath):
+        seen = {relpath}
+        pending = [relpath] + list(self.conftests(relpath))
+        while pending:
+            for dependency in self.direct(pending.pop()):
+                if dependency not in seen:
+                    seen.add(dependency)
+                    pending.append(dependency)
+        seen.update(self.conftests(relpath))
+        return seen
+
+    def save(self):
+        if self.cache_path:
+            dump_json(self.cache_path, self.imports)
+
+
+class Watcher(Server):
+    """Keeps one screen and reruns the test files affected by changes.
+
+    Runs happen in --neo-connect subprocesses, so changed modules are
+    imported again, while this process keeps the curses session.
+    """
+
+    def __init__(self, config):
+        cache_dir = get_cache_dir(config)
+        super(Watcher, self).__init__(
+            os.path.join(
+                tempfile.gettempdir(), 'neo-watch-{}.sock'.format(os.getpid())
+            ),
+            0
+        )
+        self.config = config
+        self.graph = ImportGraph(
+            str(config.rootdir),
+            cache_dir and os.path.join(cache_dir, 'imports.json')
+        )
+        self.process = None
+        self.test_files = set()
+        self.mtimes = {}
+        # project file -> test files importing it
+        self.dependents = {}
+
+    def pytest_report_collectionfinish(self, config, items):
+        return 'watching {}'.format(config.rootdir)
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        self.test_files.add(nodeid.split('::')[0])
+
+    def spawn(self, files=None):
+        args = [
+            arg for arg in self.config.invocation_params.args
+            if arg != '--neo-watch' and arg not in self.config.args
+        ]
+        if files is None:
+            args += self.config.args
+        else:
+            args += [os.path.join(str(self.config.rootdir), f) for f in files]
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'pytest'] + args + [
+                '--rootdir={}'.format(self.config.rootdir),
+                '--neo-connect={}'.format(self.path),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def get_mtime(self, relpath):
+        try:
+            return os.stat(os.path.join(self.graph.rootdir, relpath)).st_mtime
+        except OSError:
+            return None
+
+    def scan(self):
+        # files that changed during the run keep their old mtime,
+        # so they are picked up by the next check
+        dependents = collections.defaultdict(set)
+        for test_file in self.test_files:
+            for relpath in self.graph.closure(test_file):
+                dependents[relpath].add(test_file)
+                if relpath not in self.mtimes:
+                    self.mtimes[relpath] = self.get_mtime(relpath)
+        self.dependents = dict(dependents)
+        self.graph.save()
+
+    def changed_files(self):
+        changed = set()
+        for relpath, mtime in self.mtimes.items():
+            current = self.get_mtime(relpath)
+            if current != mtime:
+                self.mtimes[relpath] = current
+                changed.add(relpath)
+        return changed
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtestloop(self, session):
+        reporter = self.config.pluginmanager.getplugin('terminalreporter')
+        selector = selectors.DefaultSelector()
+        selector.register(self.listener, selectors.EVENT_READ)
+        self.spawn()
+        try:
+            while True:
+                self.poll(session, selector, WATCH_INTERVAL)
+                if self.process is not None:
+                    if self.process.poll() is None or self.clients:
+                        continue
+                    self.process = None
+                    self.scan()
+                    continue
+                changed = self.changed_files()
+                if not changed:
+                    continue
+                affected = sorted(set().union(*(
+                    self.dependents.get(relpath, ()) for relpath in changed
+                )))
+                if affected:
+                    if isinstance(reporter, NeoTerminalReporter):
+                        reporter.forget_files(affected)
+                    self.spawn(affected)
+        finally:
+            selector.close()
+            if self.process is not None:
+                self.process.kill()
+                self.process = None
+        return True
+
+
+def dispatch_event(hook, kind, nodeid, when, outcome, flags, duration):
+    location = (nodeid.partition('::')[0], None, nodeid)
+    if kind == EVENT_LOGSTART:
+        hook.pytest_runtest_logstart(nodeid=nodeid, location=location)
+    elif kind == EVENT_COLLECTREPORT:
+        hook.pytest_collectreport(
+            report=CollectReport(nodeid, outcome, None, [])
+        )
+    else:
+        hook.pytest_runtest_logreport(report=make_report(
+            nodeid, when, outcome, flags, duration
+        ))
+        if when == 'teardown':
+            hook.pytest_runtest_logfinish(nodeid=nodeid, location=location)
+
+
+def describe_failure(report):
+    crash = getattr(report.longrepr, 'reprcrash', None)
+    message = getattr(crash, 'message', None) or report.longreprtext
+    lines = message.strip().splitlines()
+    if lines:
+        return '{}  {}'.format(report.nodeid, lines[0])
+    return report.nodeid
+
+
+def get_duration(report):
+    """Duration of a single run, --neo-repeat reports the total of all."""
+    durations = getattr(report, 'neo_repeat', None)
+    if durations:
+        return statistics.median(durations)
+    return report.duration
+
+
+def is_xdist_worker(config):
+    return bool(
+        getattr(config, 'workerinput', None) or
+        getattr(config, 'slaveinput', None)
+    )
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f}GB'.format(size)
+
+
+def ansi_color(color, text):
+    return '\033[0;38;5;{}m{}\033[0m'.format(color, text)
+
+
+def get_cache_dir(config):
+    cache = getattr(config, 'cache', None)
+    if cache is None:
+        return None
+    if hasattr(cache, 'mkdir'):
+        return str(cache.mkdir('neo'))
+    return str(cache.makedir('neo'))
+
+
+def load_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def dump_json(path, data):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
 def create_stdscr():
     stdscr = curses.initscr()
     stdscr.keypad(1)
@@ -1,8 +1,36 @@
 # -*- coding: utf-8 -*-
+import json
+import os
 import pytest
+import queue
+import random
 import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
 from distutils.version import LooseVersion
 
+from pytest_neo import (
+    EVENT_LOG_COUNT,
+    EVENT_LOG_MAGIC,
+    EVENT_LOGREPORT,
+    EVENT_LOGSTART,
+    MEMORY_COLORS,
+    SLOW_FILE_DURATION,
+    SLOW_FILE_MARK,
+    ImportGraph,
+    MemoryProfiler,
+    P2Quantile,
+    Replayer,
+    Server,
+    TopList,
+    VerboseReporter,
+    encode_event,
+)
+
 pytest_plugins = "pytester"
 
 
@@ -56,6 +84,13 @@ def assert_count(testdir, *args):
     )
 
 
+def wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
 class TestTerminalReporter(object):
     def test_new_summary(self, testdir):
         testdir.makepyfile(
@@ -176,6 +211,109 @@ class TestTerminalReporter(object):
         )
         assert_count(testdir)
 
+    def test_flaky_cost(self, testdir):
+        pytest.importorskip('pytest_rerunfailures')
+        testdir.makepyfile(
+            """
+            import pytest
+
+            COUNT = 0
+
+            @pytest.mark.flaky(reruns=5)
+            def test_flaky_test():
+                global COUNT
+                COUNT += 1
+                assert COUNT >= 3
+            """
+        )
+        result = testdir.runpytest('--force-neo')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*most expensive flaky tests*',
+            '*s       2   0.20  test_flaky_cost.py::test_flaky_test',
+            '2 reruns took *s',
+        ])
+        scores = json.loads(
+            testdir.tmpdir.join('.pytest_cache/d/neo/flaky.json').read()
+        )
+        assert scores == {'test_flaky_cost.py::test_flaky_test': 0.2}
+
+    def test_rerun_cost(self, testdir):
+        # reruns the way pytest-rerunfailures does, logfinish per attempt
+        testdir.makeconftest(
+            """
+            import pytest
+            from _pytest.runner import runtestprotocol
+
+            @pytest.hookimpl(tryfirst=True)
+            def pytest_runtest_protocol(item, nextitem):
+                for attempt in range(5):
+                    item.ihook.pytest_runtest_logstart(
+                        nodeid=item.nodeid, location=item.location
+                    )
+                    reports = runtestprotocol(
+                        item, nextitem=nextitem, log=False
+                    )
+                    rerun = False
+                    for report in reports:
+                        if report.failed and attempt < 4:
+                            report.outcome = 'rerun'
+                            rerun = True
+                        item.ihook.pytest_runtest_logreport(report=report)
+                        if rerun:
+                            break
+                    item.ihook.pytest_runtest_logfinish(
+                        nodeid=item.nodeid, location=item.location
+                    )
+                    if not rerun:
+                        return True
+                return True
+            """
+        )
+        testdir.makepyfile(
+            """
+            import time
+
+            COUNT = 0
+
+            def test_flaky():
+                global COUNT
+                COUNT += 1
+                time.sleep(0.1)
+                assert COUNT >= 3
+
+            def test_stable():
+                pass
+            """
+        )
+        result = testdir.runpytest('--force-neo')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*most expensive flaky tests*',
+            '*s       2   0.20  test_rerun_cost.py::test_flaky',
+            '2 reruns took *s',
+        ])
+        flaky = testdir.tmpdir.join('.pytest_cache/d/neo/flaky.json')
+        assert json.loads(flaky.read()) == {
+            'test_rerun_cost.py::test_flaky': 0.2
+        }
+
+        testdir.makepyfile(
+            """
+            def test_flaky():
+                pass
+
+            def test_stable():
+                pass
+            """
+        )
+        result = testdir.runpytest('--force-neo')
+        assert result.ret == 0
+        assert 'most expensive flaky tests' not in result.stdout.str()
+        assert json.loads(flaky.read()) == {
+            'test_rerun_cost.py::test_flaky': 0.16
+        }
+
     def test_xpass_strict(self, testdir):
         testdir.makepyfile(
             """
@@ -506,3 +644,1069 @@ class TestTerminalReporter(object):
             'Results*:',
             '*-*test_doctest_lineno.py*:3*',
         ])
+
+    def test_durations_cache(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_slow():
+                time.sleep(0.05)
+
+            def test_fast():
+                pass
+            """
+        )
+        testdir.runpytest('--force-neo')
+        durations = json.loads(
+            testdir.tmpdir.join('.pytest_cache/d/neo/durations.json').read()
+        )
+        tests = durations['test_durations_cache.py']
+        assert tests['test_slow'] >= 50000
+        assert tests['test_fast'] < tests['test_slow']
+
+        # a removed test makes the file slow until it is dropped
+        cache = testdir.tmpdir.join('.pytest_cache/d/neo/durations.json')
+        tests['test_gone'] = int(SLOW_FILE_DURATION * 1e6)
+        cache.write(json.dumps(durations))
+        result = testdir.runpytest('--force-neo', '-k', 'test_fast')
+        assert result.ret == 0
+        assert SLOW_FILE_MARK in result.stdout.str()
+        tests = json.loads(cache.read())['test_durations_cache.py']
+        assert sorted(tests) == ['test_fast', 'test_slow']
+
+        # selecting a test by node id keeps the history of its siblings
+        result = testdir.runpytest(
+            '--force-neo', 'test_durations_cache.py::test_fast'
+        )
+        assert result.ret == 0
+        tests = json.loads(cache.read())['test_durations_cache.py']
+        assert sorted(tests) == ['test_fast', 'test_slow']
+
+        result = testdir.runpytest('--force-neo')
+        assert result.ret == 0
+        assert SLOW_FILE_MARK not in result.stdout.str()
+
+    def test_durations_cache_merge(self, testdir):
+        testdir.makepyfile(
+            test_one="""
+            class TestOne(object):
+                def test_one(self):
+                    pass
+
+            class TestOther(object):
+                def test_other(self):
+                    pass
+            """,
+            test_two="""
+            import json
+            import os
+
+            def test_two():
+                # another shard saves its run meanwhile
+                path = '.pytest_cache/d/neo/durations.json'
+                if not os.path.exists(path):
+                    return
+                durations = json.load(open(path))
+                durations['test_shard.py'] = {'test_shard': 1}
+                json.dump(durations, open(path, 'w'))
+            """,
+        )
+        assert testdir.runpytest('--force-neo').ret == 0
+        result = testdir.runpytest(
+            '--force-neo', 'test_one.py::TestOne', 'test_two.py'
+        )
+        assert result.ret == 0
+        durations = json.loads(
+            testdir.tmpdir.join('.pytest_cache/d/neo/durations.json').read()
+        )
+        assert durations['test_shard.py'] == {'test_shard': 1}
+        assert sorted(durations['test_one.py']) == [
+            'TestOne::test_one', 'TestOther::test_other',
+        ]
+
+    def test_longest_first(self, testdir):
+        testdir.makepyfile(
+            test_fast="""
+            def test_one():
+                open('order.txt', 'a').write('fast.one\\n')
+            """,
+            test_slow="""
+            import time
+
+            def test_short():
+                open('order.txt', 'a').write('slow.short\\n')
+
+            def test_long():
+                time.sleep(0.3)
+                open('order.txt', 'a').write('slow.long\\n')
+            """,
+        )
+        assert testdir.runpytest('--force-neo').ret == 0
+        testdir.tmpdir.join('order.txt').remove()
+        testdir.makepyfile(test_new="""
+            def test_unknown():
+                open('order.txt', 'a').write('new.unknown\\n')
+            """)
+        result = testdir.runpytest('--force-neo', '--neo-order=longest-first')
+        assert result.ret == 0
+        assert testdir.tmpdir.join('order.txt').read().split() == [
+            'slow.long', 'slow.short', 'new.unknown', 'fast.one',
+        ]
+
+    def test_longest_first_keeps_classes(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def log(line):
+                open('order.txt', 'a').write(line + '\\n')
+
+            class TestA(object):
+                @classmethod
+                def setup_class(cls):
+                    log('setup.a')
+
+                def test_a_slow(self):
+                    time.sleep(0.3)
+
+                def test_a_fast(self):
+                    pass
+
+            class TestB(object):
+                @classmethod
+                def setup_class(cls):
+                    log('setup.b')
+
+                def test_b_fast(self):
+                    pass
+
+                def test_b_mid(self):
+                    time.sleep(0.2)
+            """
+        )
+        assert testdir.runpytest('--force-neo').ret == 0
+        testdir.tmpdir.join('order.txt').remove()
+        result = testdir.runpytest('--force-neo', '--neo-order=longest-first')
+        assert result.ret == 0
+        assert testdir.tmpdir.join('order.txt').read().split() == [
+            'setup.a', 'setup.b',
+        ]
+        result = testdir.runpytest(
+            '--collect-only', '-q', '--neo-order=longest-first'
+        )
+        assert [
+            line.split('::', 1)[1] for line in result.stdout.lines
+            if '::' in line
+        ] == [
+            'TestA::test_a_slow', 'TestA::test_a_fast',
+            'TestB::test_b_mid', 'TestB::test_b_fast',
+        ]
+
+    def test_baseline(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_regressed():
+                time.sleep(float(open('delay.txt').read()))
+
+            def test_stable():
+                pass
+            """
+        )
+        testdir.tmpdir.join('delay.txt').write('0')
+        for _ in range(3):
+            result = testdir.runpytest(
+                '--force-neo', '--neo-baseline=save', '--neo-baseline-runs=2'
+            )
+            assert result.ret == 0
+        baseline = json.loads(
+            testdir.tmpdir.join('.pytest_cache/d/neo/baseline.json').read()
+        )
+        assert len(baseline['test_baseline.py']['test_regressed']) == 2
+
+        testdir.tmpdir.join('delay.txt').write('0.3')
+        result = testdir.runpytest('--force-neo', '--neo-baseline=compare')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*slower than the baseline*',
+            '*s *s *x  test_baseline.py::test_regressed',
+        ])
+        assert 'test_baseline.py::test_stable' not in result.stdout.str()
+
+    def test_baseline_merge(self, testdir):
+        testdir.makepyfile(
+            """
+            import json
+            import os
+
+            def test_shard():
+                # another shard saves its run meanwhile
+                path = '.pytest_cache/d/neo/baseline.json'
+                if not os.path.exists(path):
+                    return
+                baseline = json.load(open(path))
+                baseline['test_other.py'] = {'test_other': [1]}
+                json.dump(baseline, open(path, 'w'))
+            """
+        )
+        for _ in range(2):
+            result = testdir.runpytest('--force-neo', '--neo-baseline=save')
+            assert result.ret == 0
+        baseline = json.loads(
+            testdir.tmpdir.join('.pytest_cache/d/neo/baseline.json').read()
+        )
+        assert baseline['test_other.py'] == {'test_other': [1]}
+        assert len(baseline['test_baseline_merge.py']['test_shard']) == 2
+
+    def test_heatmap(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+            import time
+
+            @pytest.mark.parametrize('delay', [0, 0, 0, 0, 0, 0.05])
+            def test_delay(delay):
+                time.sleep(delay)
+            """
+        )
+        result = testdir.runpytest('--force-neo', '--neo-heatmap')
+        assert result.ret == 0
+        assert '\x1b[0;38;5;9m.' in result.stdout.str()
+
+    def test_durations_breakdown(self, testdir):
+        testdir.makepyfile(
+            test_one="""
+            def test_one():
+                pass
+            """,
+            test_two="""
+            import time
+
+            def test_two():
+                time.sleep(0.05)
+            """,
+        )
+        result = testdir.runpytest('--force-neo', '--neo-durations=1')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*slowest files*',
+            '*total*setup*call*teardown*share*',
+            '*s *% *test_two.py',
+            '*slowest directories*',
+            '*100.0% *.',
+        ])
+        assert 'test_one.py' not in result.stdout.str()
+
+    def test_fixture_profile(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+            import time
+
+            @pytest.fixture
+            def slow():
+                time.sleep(0.02)
+                yield
+                time.sleep(0.01)
+
+            @pytest.fixture(scope='module')
+            def shared():
+                pass
+
+            @pytest.mark.parametrize('index', range(3))
+            def test_fixtures(slow, shared, index):
+                pass
+            """
+        )
+        result = testdir.runpytest('--force-neo', '--neo-fixture-profile')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*fixture profile*',
+            '*setup*teardown*count*scope*fixture*',
+            '*s *s       3  function  slow',
+            '*s *s       1  module    shared',
+        ])
+
+    def test_import_profile(self, testdir):
+        testdir.makepyfile(
+            test_heavy="""
+            import time
+
+            time.sleep(0.05)
+
+            def test_heavy():
+                pass
+            """,
+            test_light="""
+            def test_light():
+                pass
+            """,
+        )
+        result = testdir.runpytest('--force-neo', '--neo-import-profile')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*collected 2 items*',
+            '*slowest imports*',
+            '*import*collect*module*',
+            '*s *s  test_heavy.py',
+            '*s *s  test_light.py',
+        ])
+
+    def test_import_profile_imports_once(self, testdir):
+        testdir.makepyfile(
+            test_broken="""
+            open('imports.txt', 'a').write('broken\\n')
+            raise ValueError('broken on purpose')
+            """,
+            test_skipped="""
+            import pytest
+
+            open('imports.txt', 'a').write('skipped\\n')
+            pytest.skip('skipped on purpose', allow_module_level=True)
+            """,
+        )
+        result = testdir.runpytest('--force-neo', '--neo-import-profile')
+        assert result.ret == 2
+        result.stdout.fnmatch_lines([
+            '*slowest imports*',
+            '*s *s  test_broken.py',
+        ])
+        imports = testdir.tmpdir.join('imports.txt').read().split()
+        assert sorted(imports) == ['broken', 'skipped']
+
+    def test_collection_error_during_progress(self, testdir):
+        testdir.makepyfile(
+            test_broken="raise ValueError(0)",
+            test_fine="""
+            def test_fine():
+                pass
+            """,
+        )
+        result = testdir.runpytest('--force-neo', '--neo-import-profile')
+        result.stdout.fnmatch_lines([
+            '*ERROR collecting test_broken.py*',
+            '*slowest imports*',
+        ])
+        assert result.stdout.str().count('E   ValueError: 0') == 1
+
+    def test_output_profile(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.fixture
+            def noisy():
+                print('s' * 1000)
+
+            def test_loud(noisy):
+                print('x' * 5000)
+
+            def test_quiet():
+                print('y')
+            """
+        )
+        result = testdir.runpytest(
+            '--force-neo', '--neo-output-profile', '--neo-output-cap=100',
+            '-rP',
+        )
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*heaviest output tests*',
+            '*5.9KB  test_output_profile.py::test_loud',
+            '*2.0B  test_output_profile.py::test_quiet',
+            '*heaviest output files*',
+            '*5.9KB  test_output_profile.py',
+            'truncated 5.7KB of output of passed tests',
+        ])
+        output = result.stdout.str()
+        assert 'x' * 5000 not in output
+        assert '[truncated 4.8KB]' in output
+
+    def test_repeat(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            CALLS = []
+
+            @pytest.fixture(scope='module')
+            def calls():
+                return CALLS
+
+            def test_counted(calls):
+                calls.append(1)
+
+            def test_check(calls):
+                assert len(calls) == 7
+
+            def test_broken():
+                assert False
+            """
+        )
+        result = testdir.runpytest(
+            '--force-neo', '--neo-repeat=5', '--neo-repeat-warmup=2'
+        )
+        assert result.ret == 1
+        result.stdout.fnmatch_lines([
+            '*repeated tests*',
+            '*min*median*p95*stdev*runs',
+        ])
+        output = result.stdout.str()
+        assert re.search(r's      5  test_repeat.py::test_counted\n', output)
+        assert re.search(r's      5  test_repeat.py::test_check\n', output)
+        assert not re.search(r's +\d+  test_repeat.py::test_broken', output)
+        assert '1 failed, 2 passed' in output
+
+    def test_repeat_captures_output(self, testdir):
+        testdir.makepyfile(
+            """
+            RUNS = []
+
+            def test_quiet():
+                print('passing output')
+
+            def test_loud():
+                RUNS.append(1)
+                print('failing output {}'.format(len(RUNS)))
+                assert len(RUNS) < 4
+            """
+        )
+        result = testdir.runpytest('--force-neo', '--neo-repeat=3')
+        assert result.ret == 1
+        output = result.stdout.str()
+        assert 'passing output' not in output
+        result.stdout.fnmatch_lines([
+            '*Captured stdout call*',
+            'failing output 1',
+            'failing output 2',
+            'failing output 3',
+            'failing output 4',
+        ])
+
+    def test_repeat_saves_single_run(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_sleep():
+                time.sleep(0.05)
+            """
+        )
+        result = testdir.runpytest(
+            '--force-neo', '--neo-repeat=10', '--neo-baseline=save'
+        )
+        assert result.ret == 0
+        cache = testdir.tmpdir.join('.pytest_cache/d/neo')
+        duration = json.loads(
+            cache.join('durations.json').read()
+        )['test_repeat_saves_single_run.py']['test_sleep']
+        assert 50000 <= duration < 250000
+        baseline, = json.loads(
+            cache.join('baseline.json').read()
+        )['test_repeat_saves_single_run.py']['test_sleep']
+        assert 50000 <= baseline < 250000
+
+    @pytest.mark.skipif(
+        not os.path.exists('/proc/stat'), reason='requires /proc'
+    )
+    def test_sysmon(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_sleep():
+                time.sleep(1.2)
+            """
+        )
+        result = testdir.runpytest('--force-neo', '--neo-sysmon')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*system utilization*',
+            'phase * wall    cpu iowait     tests  peak rss',
+            'run * *s *% *% *.*/* *B',
+        ])
+
+    @pytest.mark.skipif(
+        not os.path.exists('/proc/stat'), reason='requires /proc'
+    )
+    def test_sysmon_xdist(self, testdir):
+        pytest.importorskip('xdist')
+        testdir.makepyfile(
+            """
+            import time
+
+            def spin():
+                end = time.time() + 1.5
+                while time.time() < end:
+                    pass
+
+            def test_one():
+                spin()
+
+            def test_two():
+                spin()
+            """
+        )
+        result = testdir.runpytest_subprocess(
+            '--force-neo', '--neo-sysmon', '-n', '2'
+        )
+        assert result.ret == 0
+        match = re.search(
+            r'^run .* (\d+\.\d+)/\d+ +\S+B$', result.stdout.str(), re.M
+        )
+        assert match, result.stdout.str()
+        # the controller alone waits for the workers
+        assert float(match.group(1)) > 0.3
+
+    def test_rusage(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_sleep():
+                time.sleep(0.2)
+
+            def test_grow():
+                test_grow.data = b'x' * (20 * 1024 * 1024)
+            """
+        )
+        result = testdir.runpytest('--force-neo', '--neo-rusage')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*idle tests (sleep or I/O)*',
+            '*wall*cpu*vcsw*ivcsw*inblk*outblk*test*',
+            '*s *s *test_rusage.py::test_sleep',
+            '*max RSS growth*',
+            '*MB  test_rusage.py::test_grow',
+        ])
+        output = result.stdout.str()
+        assert '\x1b[0;38;5;12m.' in output
+        assert '\x1b[0;38;5;13m.' in output
+
+    def test_memprofile(self, testdir):
+        testdir.makepyfile(
+            """
+            LEAK = []
+
+            def test_leak():
+                LEAK.append(b'x' * (1024 * 1024))
+
+            def test_clean():
+                data = [0] * 1000
+            """
+        )
+        result = testdir.runpytest(
+            '--force-neo', '--neo-memprofile', '--neo-memprofile-every=1'
+        )
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*memory by file*',
+            '*peak*retained*file*',
+            '*MB *MB  test_memprofile.py',
+            '*top retained memory*',
+            '*MB  test_memprofile.py::test_leak',
+            '*MB    *test_memprofile.py:4',
+        ])
+
+    def test_gc(self, testdir):
+        testdir.makepyfile(
+            """
+            import gc
+
+            def test_full_collection():
+                gc.collect()
+
+            def test_nothing():
+                pass
+            """
+        )
+        result = testdir.runpytest('--force-neo', '--neo-gc')
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*garbage collection*',
+            '*pause*gen0*gen1*gen2*test*',
+            '*s       0       0       1  test_gc.py::test_full_collection',
+            '*s *total',
+        ])
+        assert '\x1b[0;38;5;14m.' in result.stdout.str()
+
+    def test_sample(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def spin():
+                end = time.time() + 0.3
+                while time.time() < end:
+                    pass
+
+            def test_spin():
+                spin()
+            """
+        )
+        output = testdir.tmpdir.join('stacks.folded')
+        result = testdir.runpytest(
+            '--force-neo', '--neo-sample', '--neo-sample-interval=1',
+            '--neo-sample-output={}'.format(output),
+        )
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*hot test files*',
+            '*s *%  test_sample.py',
+            '*hot functions*',
+            '*s *%  test_sample.py:spin',
+            'collapsed stacks: *stacks.folded',
+        ])
+        lines = output.read().splitlines()
+        assert any(
+            line.startswith(
+                'test_sample.py::test_spin;'
+                'test_sample.py:test_spin;test_sample.py:spin '
+            )
+            for line in lines
+        )
+
+    def test_sample_xdist(self, testdir):
+        pytest.importorskip('xdist')
+        testdir.makepyfile(
+            """
+            import time
+
+            def spin():
+                end = time.time() + 0.3
+                while time.time() < end:
+                    pass
+
+            def test_spin():
+                spin()
+
+            def test_other():
+                spin()
+            """
+        )
+        output = testdir.tmpdir.join('stacks.folded')
+        result = testdir.runpytest_subprocess(
+            '--force-neo', '--neo-sample', '--neo-sample-interval=1',
+            '--neo-sample-output={}'.format(output), '-n', '2',
+        )
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*hot functions*',
+            '*s *%  test_sample_xdist.py:spin',
+        ])
+        # nothing of the controller waiting for the workers
+        stacks = output.read()
+        assert 'threading.py:wait' not in stacks
+        assert 'gateway_base.py' not in stacks
+
+    def test_hang(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def wait_forever():
+                time.sleep(1.2)
+
+            def test_stuck():
+                wait_forever()
+
+            def test_quick():
+                pass
+            """
+        )
+        output = testdir.tmpdir.join('stacks.txt')
+        result = testdir.runpytest(
+            '--force-neo', '--neo-hang-timeout=0.2',
+            '--neo-hang-dump={}'.format(output),
+        )
+        assert result.ret == 0
+        result.stdout.fnmatch_lines([
+            '*hanging tests*',
+            '*s  test_hang.py::test_stuck',
+            'stacks: *stacks.txt',
+        ])
+        assert 'test_quick' not in result.stdout.str().split('hanging')[-1]
+        stacks = output.read()
+        assert stacks.startswith('test_hang.py::test_stuck running for')
+        assert 'in wait_forever' in stacks
+
+    def test_trace(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_one():
+                pass
+            """
+        )
+        trace = testdir.tmpdir.join('trace.json')
+        result = testdir.runpytest(
+            '--force-neo', '--neo-trace={}'.format(trace)
+        )
+        assert result.ret == 0
+        events = json.loads(trace.read())
+        spans = {
+            (event['cat'], event['name'])
+            for event in events if event['ph'] == 'X'
+        }
+        assert ('collect', 'test_trace.py') in spans
+        for when in ('setup', 'call', 'teardown'):
+            assert (when, 'test_trace.py::test_one') in spans
+        assert ('render', 'refresh') in spans
+        tracks = {
+            event['args']['name']
+            for event in events if event['ph'] == 'M'
+        }
+        assert tracks == {'collection', 'tests', 'neo'}
+
+    def test_failures_stream(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_broken():
+                assert 1 == 2, 'broken on purpose'
+
+            def test_written_already():
+                assert 'broken on purpose' in open('failures.txt').read()
+            """
+        )
+        result = testdir.runpytest('--force-neo', '--neo-failures=failures.txt')
+        assert result.ret == 1
+        result.stdout.fnmatch_lines([
+            '*1 failed, 1 passed*',
+        ])
+        assert 'failure details: failures.txt' in result.stdout.str()
+        details = testdir.tmpdir.join('failures.txt').read()
+        assert ' test_failures_stream.py::test_broken [call] ' in details
+        assert 'test_written_already' not in details
+
+    def test_record_and_replay(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            def test_pass():
+                pass
+
+            def test_fail():
+                assert False
+
+            @pytest.mark.xfail
+            def test_xfail():
+                assert False
+            """
+        )
+        log = testdir.tmpdir.join('events.neo')
+        result = testdir.runpytest(
+            '--force-neo', '--neo-record={}'.format(log)
+        )
+        result.stdout.fnmatch_lines(['*1 failed, 1 passed, 1 xfailed*'])
+        assert log.read_binary()[:len(EVENT_LOG_MAGIC) + 8] == (
+            EVENT_LOG_MAGIC + EVENT_LOG_COUNT.pack(3)
+        )
+
+        testdir.tmpdir.join('test_record_and_replay.py').remove()
+        result = testdir.runpytest(
+            '--force-neo', '--neo-replay={}'.format(log),
+            '--neo-replay-speed=0',
+        )
+        result.stdout.fnmatch_lines([
+            'replaying *events.neo',
+            '*1 failed, 1 passed, 1 xfailed*',
+        ])
+        assert result.ret == 1
+
+    def test_record_collect_error(self, testdir):
+        testdir.makepyfile(
+            test_ok="""
+            def test_ok():
+                pass
+            """,
+            test_broken="""
+            import missing_module
+            """,
+        )
+        log = testdir.tmpdir.join('events.neo')
+        result = testdir.runpytest(
+            '--force-neo', '--neo-record={}'.format(log),
+            '--continue-on-collection-errors',
+        )
+        assert result.ret == 1
+        result = testdir.runpytest(
+            '--force-neo', '--neo-replay={}'.format(log),
+            '--neo-replay-speed=0',
+        )
+        result.stdout.fnmatch_lines([
+            '*ERROR collecting test_broken.py*',
+            '*1 passed, 1 error*',
+        ])
+
+    def test_replay_truncated_log(self, testdir):
+        log = testdir.tmpdir.join('events.neo')
+        log.write_binary(
+            EVENT_LOG_MAGIC + EVENT_LOG_COUNT.pack(0) +
+            encode_event(EVENT_LOGSTART, 'test_a.py::test_a') +
+            encode_event(EVENT_LOGREPORT, 'test_a.py::test_a', 'call')[:-3]
+        )
+        result = testdir.runpytest(
+            '--force-neo', '--neo-replay={}'.format(log),
+            '--neo-replay-speed=0',
+        )
+        assert result.ret == 0
+        assert Replayer(str(log), 0).count() == 1
+
+    def test_replay_count_from_header(self, testdir):
+        log = testdir.tmpdir.join('events.neo')
+        log.write_binary(
+            EVENT_LOG_MAGIC + EVENT_LOG_COUNT.pack(7) +
+            encode_event(EVENT_LOGSTART, 'test_a.py::test_a')
+        )
+        # the events are not read to count the tests
+        assert Replayer(str(log), 0).count() == 7
+
+    def test_serve_and_connect(self, testdir):
+        testdir.makepyfile(
+            test_a="""
+            def test_a():
+                pass
+            """,
+            test_b="""
+            def test_b():
+                assert False
+            """,
+        )
+        path = str(testdir.tmpdir.join('neo.sock'))
+        server = testdir.popen(
+            [
+                sys.executable, '-m', 'pytest', '--force-neo',
+                '--neo-serve={}'.format(path), '--neo-shards=2',
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            deadline = time.time() + 10
+            while not os.path.exists(path) and time.time() < deadline:
+                time.sleep(0.05)
+            for name in ('test_a.py', 'test_b.py'):
+                result = testdir.runpytest(
+                    '--neo-connect={}'.format(path), name
+                )
+                # the server draws the progress
+                assert not re.search(
+                    re.escape(name) + r' [.F]', result.stdout.str()
+                )
+            server.wait(timeout=10)
+            output = server.stdout.read()
+        finally:
+            server.kill()
+        output = output.decode('utf-8', 'replace')
+        assert 'serving on {}'.format(path) in output
+        assert '1 failed, 1 passed' in strip_colors(output)
+        assert not os.path.exists(path)
+
+    def test_connect_without_server(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_a():
+                pass
+            """
+        )
+        path = str(testdir.tmpdir.join('neo.sock'))
+        result = testdir.runpytest('--neo-connect={}'.format(path))
+        assert result.ret == 4
+        result.stderr.fnmatch_lines(['*can not connect to*'])
+
+    def test_connect_server_exits(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+            import pytest
+
+            @pytest.mark.parametrize('index', range(5))
+            def test_a(index):
+                time.sleep(0.1)
+            """
+        )
+        path = str(testdir.tmpdir.join('neo.sock'))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+
+        def close():
+            client, _ = listener.accept()
+            client.close()
+            listener.close()
+
+        thread = threading.Thread(target=close)
+        thread.start()
+        try:
+            result = testdir.runpytest('--neo-connect={}'.format(path))
+        finally:
+            thread.join()
+        assert result.ret == 0
+        assert 'INTERNALERROR' not in result.stdout.str()
+        result.stdout.fnmatch_lines([
+            'lost the connection to *neo.sock: *',
+            '*5 passed*',
+        ])
+
+    def test_serve_on_regular_file(self, testdir):
+        path = testdir.tmpdir.join('neo.sock')
+        path.write('not a socket')
+        result = testdir.runpytest('--neo-serve={}'.format(path))
+        assert result.ret == 4
+        result.stderr.fnmatch_lines(['*neo.sock exists and is not a socket'])
+        assert path.read() == 'not a socket'
+
+    def test_serve_client_reset(self, testdir):
+        class ResetClient(object):
+            def recv(self, size):
+                raise ConnectionResetError()
+
+        server = Server(str(testdir.tmpdir.join('neo.sock')), 0)
+        assert server.receive(None, ResetClient()) is False
+
+    def test_watch(self, testdir):
+        testdir.makepyfile(
+            helper="""
+            VALUE = 1
+            """,
+            test_uses_helper="""
+            from helper import VALUE
+
+            def test_value():
+                assert VALUE == 1
+            """,
+            test_alone="""
+            def test_alone():
+                pass
+            """,
+        )
+        watcher = testdir.popen(
+            [sys.executable, '-m', 'pytest', '--force-neo', '--neo-watch'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        # the import graph is saved after every run
+        imports = testdir.tmpdir.join('.pytest_cache/d/neo/imports.json')
+        try:
+            wait_for(imports.exists)
+            first_run = imports.read()
+            testdir.tmpdir.join('helper.py').write('VALUE = 2\n')
+            wait_for(lambda: imports.read() != first_run)
+            second_run = imports.read()
+            # the collection error of the rerun reaches the screen
+            testdir.tmpdir.join('helper.py').write('VALUE = (\n')
+            wait_for(lambda: imports.read() != second_run)
+            watcher.send_signal(signal.SIGINT)
+            watcher.wait(timeout=10)
+            output = watcher.stdout.read()
+        finally:
+            watcher.kill()
+        output = strip_colors(output.decode('utf-8', 'replace'))
+        assert 'watching' in output
+        assert '1 passed, 1 error' in output
+        assert 'ERROR collecting test_uses_helper.py' in output
+
+    def test_import_graph(self, testdir):
+        testdir.mkpydir('pkg')
+        testdir.tmpdir.join('pkg', 'core.py').write('from . import util\n')
+        testdir.tmpdir.join('pkg', 'util.py').write('import os\n')
+        testdir.makeconftest('')
+        testdir.makepyfile(
+            test_graph="""
+            from pkg.core import something
+            """
+        )
+        graph = ImportGraph(str(testdir.tmpdir))
+        assert graph.closure('test_graph.py') == {
+            'test_graph.py',
+            'conftest.py',
+            os.path.join('pkg', '__init__.py'),
+            os.path.join('pkg', 'core.py'),
+            os.path.join('pkg', 'util.py'),
+        }
+
+
+class TestVerboseReporter(object):
+    def drain(self, reporter):
+        items = []
+        while True:
+            try:
+                items.append(reporter.queue.get(timeout=0.2)[0])
+            except queue.Empty:
+                return items
+
+    def test_drop_oldest(self):
+        reporter = VerboseReporter(0.1, 0.2, size=2, policy='drop-oldest')
+        for name in ('a', 'b', 'c', 'd'):
+            reporter.push('test_x.py::test_{}'.format(name), 0)
+        assert reporter.shed == 2
+        assert self.drain(reporter) == ['x▒test|c', 'x▒test|d']
+
+    def test_sample(self):
+        reporter = VerboseReporter(0.1, 0.2, size=1, policy='sample')
+        for index in range(25):
+            reporter.push('test_x.py::test_{}'.format(index), 0)
+        assert reporter.shed == 24
+        assert reporter.overloaded
+
+    def test_coalesce(self):
+        reporter = VerboseReporter(0.1, 0.2, size=1, policy='coalesce')
+        for index in range(5):
+            reporter.push('test_x.py::test_{}'.format(index), 0)
+        assert reporter.shed == 4
+        assert self.drain(reporter) == ['x▒test|0']
+        reporter.push('test_y.py::test_0', 0)
+        assert self.drain(reporter) == ['x']
+        assert reporter.pending[0] == 'test_y.py'
+        assert reporter.shed == 5
+
+
+class TestTopList(object):
+    def test_keeps_largest(self):
+        top = TopList(size=3)
+        for key in [5, 1, 9, 3, 7, 2]:
+            top.add(key, str(key))
+        assert top.items() == [(9, '9'), (7, '7'), (5, '5')]
+        assert len(top) == 3
+
+
+class TestP2Quantile(object):
+    @pytest.mark.parametrize('quantile', [0.5, 0.9, 0.99])
+    def test_uniform(self, quantile):
+        estimator = P2Quantile(quantile)
+        rnd = random.Random(0)
+        for _ in range(20000):
+            estimator.add(rnd.random())
+        assert estimator.value() == pytest.approx(quantile, abs=0.02)
+
+    def test_few_values(self):
+        estimator = P2Quantile(0.5)
+        assert estimator.value() is None
+        for value in [3, 1, 2]:
+            estimator.add(value)
+        assert estimator.value() == 2
+
+
+class TestMemoryProfiler(object):
+    class Config(object):
+        def getvalue(self, name):
+            return 1
+
+    class Report(object):
+        def __init__(self, peak):
+            self.nodeid = 'test_x.py::test_x'
+            self.when = 'call'
+            self.neo_memory = [peak, 0, []]
+
+    def test_heat_fed_without_glyph_color(self):
+        # another colorizer may color the glyph first
+        profiler = MemoryProfiler(self.Config())
+        for peak in [1, 2, 3, 4, 5, 6]:
+            profiler.pytest_runtest_logreport(self.Report(peak))
+        estimator = profiler.heat.estimators[0]
+        assert estimator.value() is not None
+        state = list(estimator.heights), list(estimator.positions)
+        assert profiler.glyph_color(self.Report(100)) == MEMORY_COLORS[-1]
+        assert (estimator.heights, estimator.positions) == state